@@ -10,6 +10,12 @@ GKS_K_INTSTYLE_HATCH = 3
 PATTERNS = 120
 HATCH_STYLE = 108
 GKS_K_TEXT_PRECISION_STRING = 0
+GKS_K_TEXT_PRECISION_CHAR = 1
+GKS_K_TEXT_PRECISION_STROKE = 2
+GKS_K_TEXT_PATH_RIGHT = 0
+GKS_K_TEXT_PATH_LEFT = 1
+GKS_K_TEXT_PATH_UP = 2
+GKS_K_TEXT_PATH_DOWN = 3
 MAX_COLOR = 1256
 GKS_K_TEXT_VALIGN_NORMAL = 0
 GKS_K_TEXT_VALIGN_TOP = 1
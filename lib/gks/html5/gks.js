@@ -1,23 +1,46 @@
 factor = 1
 
-var es = new EventSource("stream");
+// index.html?channel=name shows the frames of a named producer channel
+var channel = /[?&]channel=([^&]*)/.exec(location.search);
+var es = new EventSource(channel ? "stream/" + channel[1] : "stream");
 var Buffers = [document.getElementById("html-canvas"), document.getElementById("html-canvas2")];
-var DrawingBuffer = 0;
+// frames are drawn into the hidden buffer, the other one stays on screen
+var ShownBuffer = 1;
 var canvas, c;
+var FrameCount = 0, ShownFrame = 0;
 
 es.onmessage = function (e) {
-    canvas= Buffers[DrawingBuffer];
+    var buffer = 1 - ShownBuffer;
+    canvas= Buffers[buffer];
     c = canvas.getContext('2d');
 
     clear_canvas(c);
-    eval(e.data);
-
-    Buffers[1 - DrawingBuffer].style.visibility='hidden';
-    Buffers[DrawingBuffer].style.visibility='visible';
-
-    DrawingBuffer= 1 - DrawingBuffer;
+    var frame = ++FrameCount;
+    canvas.frame = frame;
+    var show = function () {
+        // frames waiting for images must not hide newer ones
+        if (frame < ShownFrame || Buffers[buffer].frame != frame) {
+            return;
+        }
+        ShownFrame = frame;
+        ShownBuffer = buffer;
+        Buffers[1 - buffer].style.visibility='hidden';
+        Buffers[buffer].style.visibility='visible';
+    };
+    var drawn = eval(e.data);
+    if (drawn) {
+        drawn.then(show);
+    } else {
+        show();
+    }
 };
 
+// definitions of frames the server skipped for this client, or all
+// definitions when the client joins
+es.addEventListener("defs", function (e) {
+    eval(e.data);
+});
+
 function set_dashes(ctx, dashes) {
     user_agent = navigator.userAgent;
     if (user_agent.indexOf("Firefox")!=-1) {
@@ -34,6 +57,167 @@ function set_dashes(ctx, dashes) {
     }
 }
 
+function decode_array(type, data) {
+    var bytes = atob(data);
+    var buffer = new Uint8Array(bytes.length);
+    for (var i = 0; i < bytes.length; i++) {
+        buffer[i] = bytes.charCodeAt(i);
+    }
+    return new type(buffer.buffer);
+}
+
+function add_path(ctx, type, data) {
+    var points = decode_array(type, data);
+    ctx.moveTo(points[0], points[1]);
+    for (var i = 2; i < points.length; i += 2) {
+        ctx.lineTo(points[i], points[i + 1]);
+    }
+}
+
+function make_sprite(size, draw) {
+    var sprite = document.createElement("canvas");
+    sprite.width = sprite.height = size;
+    draw(sprite.getContext("2d"));
+    return sprite;
+}
+
+function draw_sprites(ctx, sprite, type, data) {
+    var points = decode_array(type, data);
+    var half = sprite.width / 2;
+    for (var i = 0; i < points.length; i += 2) {
+        ctx.drawImage(sprite, Math.round(points[i] - half),
+                      Math.round(points[i + 1] - half));
+    }
+}
+
+var images = {};
+
+function load_image(id, src) {
+    if (!(id in images)) {
+        var image = new Image();
+        image.src = src;
+        images[id] = image;
+    }
+}
+
+function decode_image(id) {
+    var image = images[id];
+    if (image.complete) {
+        return Promise.resolve();
+    }
+    if (image.decode) {
+        return image.decode().catch(function () {});
+    }
+    return new Promise(function (resolve) {
+        image.onload = image.onerror = resolve;
+    });
+}
+
+var patterns = {};
+
+function make_pattern(rows, color) {
+    var tile = document.createElement("canvas");
+    tile.width = 8;
+    tile.height = rows.length;
+    var ctx = tile.getContext("2d");
+    ctx.fillStyle = color;
+    for (var j = 0; j < rows.length; j++) {
+        for (var i = 0; i < 8; i++) {
+            if (!(rows[j] & (1 << i))) {
+                ctx.fillRect((i + 7) % 8, (j + rows.length - 1) % rows.length, 1, 1);
+            }
+        }
+    }
+    return ctx.createPattern(tile, "repeat");
+}
+
+var glyphs = {};
+
+function make_glyph(subpaths) {
+    return subpaths.map(function (points) {
+        var path = new Path2D();
+        path.moveTo(points[0], points[1]);
+        for (var i = 2; i < points.length; i += 2) {
+            path.lineTo(points[i], points[i + 1]);
+        }
+        return path;
+    });
+}
+
+// Stroke the glyphs placed by [id, a, b, c, d, e, f] transforms as one
+// path. The glyphs are transformed into device space before stroking,
+// so the line width is not scaled with the text.
+function draw_glyphs(ctx, placements, filled) {
+    var text = new Path2D();
+    placements.forEach(function (placement) {
+        var matrix = new DOMMatrix(placement.slice(1));
+        glyphs[placement[0]].forEach(function (subpath) {
+            if (filled) {
+                var area = new Path2D();
+                area.addPath(subpath, matrix);
+                ctx.fill(area);
+            }
+            text.addPath(subpath, matrix);
+        });
+    });
+    ctx.stroke(text);
+}
+
+// Forget the images the server has evicted from its cache.
+function unload_images(ids) {
+    ids.forEach(function (id) { delete images[id]; });
+}
+
+// Load the images, patterns and glyphs new to this client, and forget
+// the deleted images.
+function load_defs(defs) {
+    var id;
+    for (id in defs.images) {
+        load_image(id, defs.images[id]);
+    }
+    for (id in defs.patterns) {
+        patterns[id] = make_pattern(defs.patterns[id][0], defs.patterns[id][1]);
+    }
+    for (id in defs.glyphs) {
+        glyphs[id] = make_glyph(defs.glyphs[id]);
+    }
+    if (defs.deleted) {
+        unload_images(defs.deleted);
+    }
+}
+
+// Replace everything loaded so far by all definitions the server holds.
+function reset_defs(defs) {
+    images = {};
+    patterns = {};
+    glyphs = {};
+    load_defs(defs);
+}
+
+// Draw a frame once all of its images are decoded. The images are
+// decoded in parallel; without images the frame is drawn right away.
+// defs holds the images, patterns and glyphs new to this client, deleted
+// the images the frame evicted, which are forgotten once it is drawn.
+function draw_frame(draw, ids, defs, deleted) {
+    deleted = deleted || [];
+    var ctx = c;
+    var frame = ctx.canvas.frame;
+    load_defs(defs);
+    ids = ids.filter(function (id) { return id in images; });
+    if (ids.length == 0) {
+        draw(ctx);
+        unload_images(deleted);
+        return null;
+    }
+    return Promise.all(ids.map(decode_image)).then(function () {
+        // skip the frame if its canvas has been reused meanwhile
+        if (ctx.canvas.frame == frame) {
+            draw(ctx);
+        }
+        unload_images(deleted);
+    });
+}
+
 function key_pressed(event) {
     if (event.keyCode == 43 || event.which == 43) { // + pressed
         zoom_in();
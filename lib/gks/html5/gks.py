@@ -1,27 +1,15 @@
 from ctypes import *
 from constants import *
 
-line_callback = None
-fill_callback = None
-
-fill_prototype = CFUNCTYPE(
-    c_void_p, c_int, POINTER(c_double), POINTER(c_double), c_int)
-line_prototype = CFUNCTYPE(
-    c_void_p, c_int, POINTER(c_double), POINTER(c_double), c_int, c_int)
+color_table = None
+pattern_arrays = {}
+dash_lists = {}
+font_glyphs = {}
+afm_glyphs = {}
 
 _gks = CDLL('/usr/local/gr/lib/libGKS.so')
 
 
-def set_line_callback(lrc):
-    global line_callback
-    line_callback = line_prototype(lrc)
-
-
-def set_fill_callback(frc):
-    global fill_callback
-    fill_callback = fill_prototype(frc)
-
-
 class state_list(Structure):
     _fields_ = [
         ('lindex', c_int),
@@ -72,6 +60,20 @@ class state_list(Structure):
     def copy_data(self, bytes):
         memmove(addressof(self), bytes, sizeof(self))
 
+
+class stroke_data(Structure):
+    _fields_ = [
+        ('left', c_int),
+        ('right', c_int),
+        ('size', c_int),
+        ('bottom', c_int),
+        ('base', c_int),
+        ('cap', c_int),
+        ('top', c_int),
+        ('length', c_int),
+        ('coord', (c_int * 2) * 124)
+    ]
+
 _gks.gks_set_dev_xform.argtypes = (POINTER(state_list), POINTER(c_double),
                                    POINTER(c_double))
 _gks.gks_inq_pattern_array.argtypes = (c_int, c_int * 33)
@@ -79,9 +81,9 @@ _gks.gks_inq_rgb.argtypes = (
     c_int, POINTER(c_double), POINTER(c_double), POINTER(c_double))
 _gks.gks_get_dash_list.argtypes = (c_int, c_double, c_int * 10)
 _gks.gks_init_core.argtypes = (POINTER(state_list),)
+_gks.gks_lookup_font.argtypes = (c_int, c_int, c_int, c_int, POINTER(stroke_data))
+_gks.gks_lookup_afm.argtypes = (c_int, c_int, POINTER(stroke_data))
 _gks.gks_open_font.argtypes = []
-_gks.gks_emul_text.argtypes = (
-    c_double, c_double, c_int, c_char_p, line_prototype, fill_prototype)
 _gks.gks_set_norm_xform.argtypes = (
     c_int, POINTER(c_double), POINTER(c_double))
 
@@ -102,11 +104,15 @@ def set_dev_xform(s_list, window, viewport):
 
 
 def inq_pattern_array(index):
+    ''' return the rows of a fill pattern; the list is shared, do not modify it '''
     global _gks
-    pattern = (c_int * 33)()
-    _gks.gks_inq_pattern_array(c_int(index), pattern)
-    n = pattern[0]
-    return [i for i in pattern[1:n+1]]
+
+    if index not in pattern_arrays:
+        pattern = (c_int * 33)()
+        _gks.gks_inq_pattern_array(c_int(index), pattern)
+        n = pattern[0]
+        pattern_arrays[index] = [i for i in pattern[1:n+1]]
+    return pattern_arrays[index]
 
 
 def inq_rgb(color_index):
@@ -116,15 +122,61 @@ def inq_rgb(color_index):
     return [c.value for c in color]
 
 
+def inq_color_table():
+    ''' return the RGB values of all color indices
+
+    The table is queried from libGKS once and shared afterwards; color
+    representations set by a display list are applied by the caller.
+    '''
+    global _gks, color_table
+
+    if color_table is None:
+        color = [c_double(0) for i in range(3)]
+        refs = [byref(c) for c in color]
+        table = []
+        for color_index in range(MAX_COLOR):
+            _gks.gks_inq_rgb(color_index, *refs)
+            table.append(tuple(c.value for c in color))
+        color_table = tuple(table)
+    return color_table
+
+
 def get_dash_list(ltype, scale):
+    ''' return the dash list of a line type; the list is shared, do not modify it '''
+    global _gks
+
+    key = (ltype, scale)
+    if key not in dash_lists:
+        lt = c_int * 10
+        l = lt()
+        _gks.gks_get_dash_list(c_int(ltype), c_double(scale), l)
+
+        dash_lists[key] = [i for i in l[1:] if i != 0]
+    return dash_lists[key]
+
+
+def lookup_font(fd, version, font, chr):
+    ''' return the stroke data of a character; the result is shared, do not modify it '''
     global _gks
 
-    lt = c_int * 10
-    l = lt()
-    _gks.gks_get_dash_list(c_int(ltype), c_double(scale), l)
+    key = (fd, version, font, chr)
+    if key not in font_glyphs:
+        s = stroke_data()
+        _gks.gks_lookup_font(fd, version, font, chr, byref(s))
+        font_glyphs[key] = s
+    return font_glyphs[key]
+
+
+def lookup_afm(font, chr):
+    ''' return the metrics of a character; the result is shared, do not modify it '''
+    global _gks
 
-    l = [i for i in l[1:] if i != 0]
-    return l
+    key = (font, chr)
+    if key not in afm_glyphs:
+        s = stroke_data()
+        _gks.gks_lookup_afm(font, chr, byref(s))
+        afm_glyphs[key] = s
+    return afm_glyphs[key]
 
 
 def init_core(list):
@@ -140,12 +192,6 @@ def open_font():
     return fd
 
 
-def emul_text(x_pos, y_pos, text):
-    _gks.gks_emul_text(c_double(x_pos), c_double(y_pos),
-                       c_int(len(text)), c_char_p(text),
-                       line_callback, fill_callback)
-
-
 def set_norm_xform(tnr, window, viewport):
     c_window = (c_double*len(window))()
     for i in range(len(window)):
@@ -1,10 +1,18 @@
 import sys
-from math import sqrt, pi, atan2
+from math import sqrt, pi, atan2, floor, sin, cos
 import zlib
 import struct
+import base64
+import hashlib
+from collections import OrderedDict
 import gks
 from constants import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 fonts = [
     "Times New Roman", "Arial", "Courier", "Open Symbol",
     "Bookman Old Style", "Century Schoolbook", "Century Gothic",
@@ -37,6 +45,380 @@ b = [0.0 for i in range(MAX_TNR)]
 c = [1.0 for i in range(MAX_TNR)]
 d = [0.0 for i in range(MAX_TNR)]
 
+# stroke fonts used for hardware fonts, see map_font in gks util.c
+roman = [3, 12, 16, 11]
+greek = [4, 7, 10, 7]
+
+xfac = [1, -1, 0, 0]
+yfac = [0, 0, 1, -1]
+
+# default color table and styles, shared by all frames
+default_rgb = None
+default_styles = None
+
+
+def as_list(values):
+    ''' convert NumPy array arguments to Python lists in a single step '''
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return values
+
+
+def encode_points(xd, yd, quantize=False):
+    ''' pack device coordinates into an interleaved typed array
+
+    Returns the name of the JavaScript array type and the base64 encoded
+    little-endian data. With quantize, the points are rounded to device
+    pixels and sent as Int16Array if they fit.
+    '''
+    if numpy is not None and isinstance(xd, numpy.ndarray):
+        points = numpy.empty(2 * len(xd))
+        points[0::2] = xd
+        points[1::2] = yd
+        if quantize:
+            points = numpy.round(points)
+            if points.min() >= -32768 and points.max() <= 32767:
+                data = points.astype('<i2').tobytes()
+                return ('Int16Array', base64.b64encode(data).decode('ascii'))
+        data = points.astype('<f4').tobytes()
+        return ('Float32Array', base64.b64encode(data).decode('ascii'))
+
+    points = [v for xy in zip(as_list(xd), as_list(yd)) for v in xy]
+    if quantize:
+        ipoints = [int(round(v)) for v in points]
+        if min(ipoints) >= -32768 and max(ipoints) <= 32767:
+            data = struct.pack('<%dh' % len(ipoints), *ipoints)
+            return ('Int16Array', base64.b64encode(data).decode('ascii'))
+    data = struct.pack('<%df' % len(points), *points)
+    return ('Float32Array', base64.b64encode(data).decode('ascii'))
+
+
+markers = [
+    # omark
+    [ 5, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
+      -700, -400, -700, 400, -400, 700,
+      3, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
+      -700, -400, -700, 400, -400, 700, 0 ],
+    # hline
+    [ 2, -1000, 0, 1000, 0, 0 ],
+    # vline
+    [ 2, 0, -1000, 0, 1000, 0 ],
+    # star8
+    [ 4, 16,  0, -1000, 153, -370, 707, -707, 370, -153, 1000, 0, 370, 153,
+      707, 707, 153, 370, 0, 1000, -153, 370, -707, 707, -370, 153, -1000, 0,
+      -370, -153, -707, -707, -153, -370, 0 ],
+    # star7
+    [ 4, 14,  0, 1000, 174, 360, 782, 623, 390, 89, 975, -223, 313, -249,
+      434, -901, 0, -400, -434, -901, -313, -249, -975, -223, -390, 89,
+      -782, 623, -174, 360, 0 ],
+    # star6
+    [ 4, 12,  0, -1000, 200, -346, 866, -500, 400, 0, 866, 500, 200, 346, 0,
+      1000, -200, 346, -866, 500, -400, 0, -866, -500, -200, -346, 0 ],
+    # star5
+    [ 4, 10,  0, 1000, 235, 324, 951, 309, 380, -124, 588, -809, 0, -400,
+      -588, -809, -380, -124, -951, 309, -235, 324, 0 ],
+    # star4
+    [ 4, 8,  0, -1000, 283, -283, 1000, 0, 283, 283, 0, 1000, -283, 283,
+      -1000, 0, -283, -283, 0 ],
+    # octagon
+    [ 4, 8,  0, -1000, 707, -707, 1000, 0, 707, 707, 0, 1000, -707, 707,
+      -1000, 0, -707, -707, 0 ],
+    # heptagon
+    [ 4, 7,  0, 1000, 782, 623, 975, -223, 434, -901, -434, -901,
+      -975, -223, -782, 623, 0 ],
+    # hexagon
+    [ 4, 6,  0, -1000, 866, -500, 866, 500, 0, 1000, -866, 500, -866, -500,
+      0 ],
+    # pentagon
+    [ 4, 5,  0, 1000, 951, 309, 588, -809, -588, -809, -951, 309, 0 ],
+    # omark
+    [ 5, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
+      -700, -400, -700, 400, -400, 700,
+      3, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
+      -700, -400, -700, 400, -400, 700, 0 ],
+    # hollow plus
+    [ 5, 13, -200, 800, 200, 800, 200, 200, 800, 200, 800, -200, 200, -200,
+      200, -800, -200, -800, -200, -200, -800, -200, -800, 200, -200, 200,
+      -200, 800,
+      3, 13, -200, 800, 200, 800, 200, 200, 800, 200, 800, -200, 200, -200,
+      200, -800, -200, -800, -200, -200, -800, -200, -800, 200, -200, 200,
+      -200, 800, 0 ],
+    # solid triangle right
+    [ 4, 4, -800, 0, 400, 700, 400, -700, -800, 0, 0 ],
+    # solid triangle left
+    [ 4, 4, 800, 0, -400, -700, -400, 700, 800, 0, 0 ],
+    # triangle up down
+    [ 5, 4, 0, 800, 700, -400, -700, -400, 0, 800,
+      5, 4, 0, -800, -700, 400, 700, 400, 0, -800,
+      3, 4, 0, 800, 700, -400, -700, -400, 0, 800,
+      3, 4, 0, -800, -700, 400, 700, 400, 0, -800, 0 ],
+    # solid star
+    [ 4, 11, 0, 900, 200, 200, 900, 300, 300, -100, 600, -800, 0, -300,
+      -600, -800, -300, -100, -900, 300, -200, 200, 0, 900, 0 ],
+    # hollow star
+    [ 5, 11, 0, 900, 200, 200, 900, 300, 300, -100, 600, -800, 0, -300,
+      -600, -800, -300, -100, -900, 300, -200, 200, 0, 900,
+      3, 11, 0, 900, 200, 200, 900, 300, 300, -100, 600, -800, 0, -300,
+      -600, -800, -300, -100, -900, 300, -200, 200, 0, 900, 0 ],
+    # solid diamond
+    [ 4, 5, 0, 1000, 1000, 0, 0, -1000, -1000, 0, 0, 1000, 0],
+    # hollow diamond
+    [ 5, 5, 0, 1000, 1000, 0, 0, -1000, -1000, 0, 0, 1000,
+      3, 5, 0, 1000, 1000, 0, 0, -1000, -1000, 0, 0, 1000, 0 ],
+    # solid hourglass
+    [ 4, 5, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 1000, 0 ],
+    # hollow hourglass
+    [ 5, 5, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 1000,
+      3, 5, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 1000, 0 ],
+    # solid bowtie
+    [ 4, 5, 1000, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 0 ],
+    # hollow bowtie
+    [ 5, 5, 1000, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000,
+      3, 5, 1000, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 0 ],
+    # solid square
+    [ 4, 5, 1000, 1000, 1000, -1000, -1000, -1000, -1000, 1000, 1000, 1000, 0 ],
+    # hollow square
+    [ 5, 5, 1000, 1000, 1000, -1000, -1000, -1000, -1000, 1000, 1000, 1000,
+      3, 5, 1000, 1000, 1000, -1000, -1000, -1000, -1000, 1000, 1000, 1000, 0 ],
+    # solid triangle down
+    [ 4, 4, -1000, 1000, 1000, 1000, 0, -1000, -1000, 1000, 0 ],
+    # hollow triangle down
+    [ 5, 4, -1000, 1000, 1000, 1000, 0, -1000, -1000, 1000,
+      3, 4, -1000, 1000, 1000, 1000, 0, -1000, -1000, 1000, 0 ],
+    # solid triangle up
+    [ 4, 4, 0, 1000, 1000, -1000, -1000, -1000, 0, 1000, 0 ],
+    # hollow triangle up
+    [ 5, 4, 0, 1000, 1000, -1000, -1000, -1000, 0, 1000,
+      3, 4, 0, 1000, 1000, -1000, -1000, -1000, 0, 1000, 0 ],
+    # solid circle
+    [ 7, 0 ],
+    # not used
+    [ 0 ],
+    # dot
+    [ 1, 0 ],
+    # plus
+    [ 2, 0, 0, 0, 1000, 2, 0, 0, 1000, 0, 2, 0, 0, 0, -1000,
+      2, 0, 0, -1000, 0, 0 ],
+    # asterisk
+    [ 2, 0, 0, 0, 1000, 2, 0, 0, 1000, 300,
+      2, 0, 0, 600, -1000, 2, 0, 0, -600, -1000,
+      2, 0, 0, -1000, 300, 0 ],
+    # circle
+    [ 8, 6, 0 ],
+    # diagonal cross
+    [ 2, 0, 0, 1000, 1000, 2, 0, 0, 1000, -1000,
+      2, 0, 0, -1000, -1000, 2, 0, 0, -1000, 1000, 0 ]
+]
+
+
+def parse_marker(code):
+    ''' split a marker definition into (op, arguments) tuples '''
+    ops = []
+    pc = 0
+    while code[pc] != 0:
+        op = code[pc]
+        if op == 2:
+            ops.append((op, tuple(code[pc + 1:pc + 5])))
+            pc += 5
+        elif op in (3, 4, 5):
+            n = code[pc + 1]
+            ops.append((op, tuple(code[pc + 2:pc + 2 + 2 * n])))
+            pc += 2 + 2 * n
+        else:
+            ops.append((op, ()))
+            pc += 1
+    return tuple(ops)
+
+
+marker_ops = [parse_marker(code) for code in markers]
+
+
+def is_monotonic(xd):
+    ''' check whether the x coordinates never change direction '''
+    if numpy is not None and isinstance(xd, numpy.ndarray):
+        dx = numpy.diff(xd)
+        return bool((dx >= 0).all() or (dx <= 0).all())
+    xd = as_list(xd)
+    pairs = list(zip(xd, xd[1:]))
+    return all(x0 <= x1 for (x0, x1) in pairs) or \
+        all(x0 >= x1 for (x0, x1) in pairs)
+
+
+def decimate_columns(xd, yd):
+    ''' keep the first, last, lowest and highest point of each pixel column
+
+    For paths with monotonic x the result renders pixel-identical to the
+    full path.
+    '''
+    n = len(xd)
+    if numpy is not None and isinstance(xd, numpy.ndarray):
+        columns = numpy.floor(xd)
+        starts = numpy.concatenate(
+            ([0], numpy.flatnonzero(columns[1:] != columns[:-1]) + 1))
+        ends = numpy.concatenate((starts[1:], [n])) - 1
+        groups = numpy.repeat(numpy.arange(len(starts)), ends - starts + 1)
+        # lexsort is stable, so ties go to the first point, as below
+        low = numpy.lexsort((yd, groups))[starts]
+        high = numpy.lexsort((-yd, groups))[starts]
+        keep = numpy.unique(numpy.concatenate((starts, ends, low, high)))
+        return (xd[keep], yd[keep])
+
+    xd = as_list(xd)
+    yd = as_list(yd)
+    keep = []
+    column = None
+    for i in range(n):
+        if floor(xd[i]) != column:
+            if column is not None:
+                keep.extend(sorted(set((first, low, high, i - 1))))
+            column = floor(xd[i])
+            first = low = high = i
+        elif yd[i] < yd[low]:
+            low = i
+        elif yd[i] > yd[high]:
+            high = i
+    if column is not None:
+        keep.extend(sorted(set((first, low, high, n - 1))))
+    return ([xd[i] for i in keep], [yd[i] for i in keep])
+
+
+def simplify(xd, yd, tolerance):
+    ''' drop inner points of runs that stay within one tolerance cell
+
+    The cells are small enough that no dropped point is farther than
+    tolerance from the simplified path.
+    '''
+    n = len(xd)
+    size = tolerance / sqrt(2)
+    if numpy is not None and isinstance(xd, numpy.ndarray):
+        cx = numpy.floor(xd / size)
+        cy = numpy.floor(yd / size)
+        change = (cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1])
+        keep = numpy.ones(n, dtype=bool)
+        keep[1:-1] = change[:-1] | change[1:]
+        return (xd[keep], yd[keep])
+
+    xd = as_list(xd)
+    yd = as_list(yd)
+    cells = [(floor(x / size), floor(y / size)) for (x, y) in zip(xd, yd)]
+    keep = [i for i in range(n) if i == 0 or i == n - 1 or
+            cells[i] != cells[i - 1] or cells[i] != cells[i + 1]]
+    return ([xd[i] for i in keep], [yd[i] for i in keep])
+
+
+path_ends = {'stroke': 'c.stroke();\n', 'fill': 'c.fill();\n'}
+
+# bounds the overlap checks of batched fills
+MAX_SUBPATHS = 256
+
+
+def bounds(xd, yd):
+    ''' return the bounding box (xmin, xmax, ymin, ymax) of a path '''
+    if numpy is not None and isinstance(xd, numpy.ndarray):
+        return (xd.min(), xd.max(), yd.min(), yd.max())
+    return (min(xd), max(xd), min(yd), max(yd))
+
+
+def overlaps(e1, e2):
+    ''' check whether the interiors of two bounding boxes intersect '''
+    return e1[0] < e2[1] and e2[0] < e1[1] and e1[2] < e2[3] and e2[2] < e1[3]
+
+
+def inside(rect, x, y, margin=0):
+    ''' check whether a point lies within margin of a rectangle '''
+    (xmin, xmax, ymin, ymax) = rect
+    return xmin - margin <= x <= xmax + margin and ymin - margin <= y <= ymax + margin
+
+
+def points_inside(xd, yd, rect):
+    ''' return the points that lie within a rectangle '''
+    (xmin, xmax, ymin, ymax) = rect
+    if numpy is not None and isinstance(xd, numpy.ndarray):
+        mask = (xd >= xmin) & (xd <= xmax) & (yd >= ymin) & (yd <= ymax)
+        return (xd[mask], yd[mask])
+    points = [(x, y) for (x, y) in zip(xd, yd) if xmin <= x <= xmax and ymin <= y <= ymax]
+    return ([x for (x, y) in points], [y for (x, y) in points])
+
+
+def visible_spans(xd, yd, rect):
+    ''' return the (start, stop) index ranges of the points of a polyline
+        which are needed to draw its part inside a rectangle
+
+    A segment is kept if its bounding box meets the rectangle, so every
+    span includes one point on each side of the visible part.
+    '''
+    (xmin, xmax, ymin, ymax) = rect
+    if numpy is not None and isinstance(xd, numpy.ndarray):
+        (x0, x1, y0, y1) = (xd[:-1], xd[1:], yd[:-1], yd[1:])
+        hidden = (((x0 < xmin) & (x1 < xmin)) | ((x0 > xmax) & (x1 > xmax)) |
+                  ((y0 < ymin) & (y1 < ymin)) | ((y0 > ymax) & (y1 > ymax)))
+        edges = numpy.diff(numpy.concatenate(([0], (~hidden).astype(numpy.int8), [0])))
+        starts = numpy.flatnonzero(edges == 1)
+        stops = numpy.flatnonzero(edges == -1) + 1
+        return list(zip(starts.tolist(), stops.tolist()))
+    xd = as_list(xd)
+    yd = as_list(yd)
+    spans = []
+    start = None
+    for i in range(len(xd) - 1):
+        (x0, x1, y0, y1) = (xd[i], xd[i + 1], yd[i], yd[i + 1])
+        hidden = ((x0 < xmin and x1 < xmin) or (x0 > xmax and x1 > xmax) or
+                  (y0 < ymin and y1 < ymin) or (y0 > ymax and y1 > ymax))
+        if not hidden and start is None:
+            start = i
+        elif hidden and start is not None:
+            spans.append((start, i + 1))
+            start = None
+    if start is not None:
+        spans.append((start, len(xd)))
+    return spans
+
+
+def concat(arrays):
+    ''' join coordinate arrays, keeping NumPy arrays if possible '''
+    if numpy is not None and all(isinstance(a, numpy.ndarray) for a in arrays):
+        return numpy.concatenate(arrays)
+    return [v for a in arrays for v in as_list(a)]
+
+
+def filter_rows(rows, bpp):
+    ''' apply the PNG None, Sub or Up filter to each row of a pixel array
+
+    Per row, the filter with the smallest sum of absolute signed
+    differences is chosen, as suggested by the PNG specification.
+    '''
+    sub = rows.copy()
+    sub[:, bpp:] -= rows[:, :-bpp]
+    up = rows.copy()
+    up[1:] -= rows[:-1]
+    candidates = numpy.stack((rows, sub, up))
+    scores = numpy.abs(candidates.view(numpy.int8).astype(numpy.int32)).sum(axis=2)
+    choice = scores.argmin(axis=0)
+    filtered = numpy.empty((rows.shape[0], rows.shape[1] + 1), dtype=numpy.uint8)
+    filtered[:, 0] = choice
+    filtered[:, 1:] = candidates[choice, numpy.arange(rows.shape[0])]
+    return filtered.tobytes()
+
+
+def shape_extent(shape, r):
+    ''' return the largest distance of a marker shape from its center '''
+    return max([r] + [max(abs(xr), abs(yr)) for (op, args) in shape
+                      if op in (2, 3, 4, 5) for (xr, yr) in args])
+
+
+def map_font(font):
+    ''' map a hardware text font to a stroke font '''
+    font = abs(font)
+    family = (font - 1) % 8 + 1
+    font_type = min((font - 1) // 8, 3)
+    return roman[font_type] if family != 7 else greek[font_type]
+
+
+def mat_mul(m1, m2):
+    ''' multiply two 3x3 matrices '''
+    return tuple(tuple(sum(m1[i][k] * m2[k][j] for k in range(3))
+                       for j in range(3)) for i in range(3))
+
 
 class ws_state_list(object):
     def __init__(self):
@@ -61,8 +443,122 @@ class ws_state_list(object):
         self.clip_rect = None
 
 
+class Buffered_writer(object):
+    ''' collect output chunks and pass them on in large blocks
+
+    The target is a file-like object, a socket or None; without a target
+    the output is kept in memory until getvalue() is called.
+    '''
+
+    def __init__(self, target=None, compact=False, block_size=65536):
+        self.target = target
+        self.compact = compact
+        self.block_size = block_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, s, level=0):
+        if level and not self.compact:
+            s = level * '  ' + s
+        self.chunks.append(s)
+        self.size += len(s)
+        if self.target is not None and self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.target is None or not self.chunks:
+            return
+        data = self.getvalue()
+        self.chunks = []
+        self.size = 0
+        if hasattr(self.target, 'sendall'):
+            self.target.sendall(data)
+        else:
+            self.target.write(data)
+
+    def getvalue(self):
+        ''' return the buffered output as one bytes object '''
+        data = ''.join(self.chunks)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+
+def format_defs(images=(), patterns=(), glyphs=(), deleted=()):
+    ''' return the members of a JavaScript object that defines images,
+        patterns and glyphs by id and lists the ids of deleted images
+    '''
+    defs = []
+    if images:
+        defs.append('images: {{{0}}}'.format(', '.join(
+            '{0}: "{1}"'.format(image_id, data_uri)
+            for (image_id, data_uri) in images)))
+    if patterns:
+        defs.append('patterns: {{{0}}}'.format(', '.join(
+            '{0}: [{1}, "{2}"]'.format(pattern_id, rows, color)
+            for (pattern_id, rows, color) in patterns)))
+    if glyphs:
+        defs.append('glyphs: {{{0}}}'.format(', '.join(
+            '{0}: {1}'.format(glyph_id, subpaths)
+            for (glyph_id, subpaths) in glyphs)))
+    if deleted:
+        defs.append('deleted: [{0}]'.format(', '.join(str(image_id) for image_id in deleted)))
+    return ', '.join(defs)
+
+
+class Image_cache(object):
+    ''' keep the data URIs of recently encoded images across frames
+
+    Entries are keyed by a hash of everything that determines the pixels
+    and evicted in least recently used order once max_entries or max_bytes
+    is exceeded. Each entry has an id, so that a live client which already
+    holds an image only has to be told which one to draw.
+    '''
+
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.next_id = 0
+        self.sent = set()
+        self.evicted = []
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def store(self, key, data_uri):
+        entry = (self.next_id, data_uri)
+        self.next_id += 1
+        self.entries[key] = entry
+        self.size += len(data_uri)
+        # the new entry stays even if it is larger than max_bytes, as it
+        # is about to be drawn and sent
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or
+                                         self.size > self.max_bytes):
+            (image_id, uri) = self.entries.popitem(last=False)[1]
+            self.size -= len(uri)
+            if image_id in self.sent:
+                self.sent.discard(image_id)
+                self.evicted.append(image_id)
+        return entry
+
+    def report(self):
+        return '{0} hits, {1} misses, {2} images in {3} bytes'.format(
+            self.hits, self.misses, len(self.entries), self.size)
+
+
 class Html_output(object):
-    def __init__(self, gks_state_list, data, n):
+    def __init__(self, gks_state_list, data, n, output=None, compact=False,
+                 **options):
         if n >= 250:
             print("Maximum number of HTML output files reached")
             sys.exit(0)
@@ -71,28 +567,14 @@ class Html_output(object):
         else:
             self.filename = 'gks.html'
         self.title = 'GKS'
-        self.gkss = gks_state_list
-        self.p = ws_state_list()
-        self.file = open(self.filename, 'w')
-        self.p.width = 500
-        self.p.height = 500
-        self.p.window = [0.0, 1.0, 0.0, 1.0]
-        self.p.viewport = [self.p.width * MWIDTH / WIDTH, 0.,
-                           self.p.height * MHEIGHT / HEIGHT]
-        self.p.rgb = [[] for i in range(MAX_COLOR)]
-        self.p.dashes = []
-        self.indentation = 0
-        self.p.rect = [() for i in range(MAX_TNR)]
-        self.p.clip_rect = ()
-        self.transparency = 1.0
-
-        self.set_xform()
-        self.init_norm_xform()
-        self.init_colors()
+        self.file = output if output is not None else open(self.filename, 'wb')
 
         if not self.file:
             print("Can't open HTML output file")
 
+        self.init_output(gks_state_list, Buffered_writer(self.file, compact),
+                         **options)
+
         self.write('<!DOCTYPE html>\n')
         self.write('<html>\n')
         self.write('  <head>\n')
@@ -110,9 +592,6 @@ class Html_output(object):
         self.indentation = 1
         self.init_canvas()
 
-        gks.set_fill_callback(self.fill_routine)
-        gks.set_line_callback(self.line_routine)
-
         self.write('base_width = canvas.width;\n')
         self.write('base_height = canvas.height;\n')
 
@@ -131,19 +610,91 @@ class Html_output(object):
 </body>
 </html>
 '''
+        self.render(data)
+        self.out.flush()
+        if output is None:
+            self.file.close()
+
+        if self.verbose:
+            self.report()
+
+    def init_output(self, gks_state_list, out, path_encoding='text',
+                    decimate=False, tolerance=0.5, marker_sprites=True,
+                    batch_paths=True, png_level=6, png_filter='adaptive',
+                    image_cache=None, patterns=None, glyphs=None,
+                    cull=True, verbose=False):
+        self.path_encoding = path_encoding
+        self.image_cache = image_cache or Image_cache()
+        self.sent_images = set()
+        self.frame_images = []
+        self.frame_sources = []
+        self.frame_deleted = []
+        self.patterns = patterns if patterns is not None else {}
+        self.frame_patterns = []
+        self.glyphs = glyphs if glyphs is not None else {}
+        self.frame_glyphs = []
+        self.fill_color = None
+        self.png_level = png_level
+        self.png_filter = png_filter
+        self.batch_paths = batch_paths
+        self.cull = cull
+        self.path = None
+        self.marker_sprites = marker_sprites
+        self.sprites = {}
+        self.decimate = decimate
+        self.tolerance = tolerance
+        self.verbose = verbose
+        self.stats = {'points_in': 0, 'points_out': 0}
+        self.gkss = gks_state_list
+        self.p = ws_state_list()
+        self.out = out
+        self.p.width = 500
+        self.p.height = 500
+        self.p.window = [0.0, 1.0, 0.0, 1.0]
+        self.p.viewport = [self.p.width * MWIDTH / WIDTH, 0.,
+                           self.p.height * MHEIGHT / HEIGHT]
+        self.p.dashes = []
+        self.indentation = 0
+        self.p.rect = [() for i in range(MAX_TNR)]
+        self.p.clip_rect = ()
+        self.transparency = 1.0
+        self.xforms = [None for i in range(MAX_TNR)]
+        self.font_layouts = {}
+
+        self.set_xform()
+        self.init_norm_xform()
+        self.init_colors()
+
+    def render(self, data):
+        self.write('draw_frame(function(c) {\n')
+        self.indentation += 1
         for d in data:
             getattr(self, d[0])(*d[1])
 
-        self.file.write(self.footer)
-        self.file.close()
+        self.flush_path()
+        self.indentation -= 1
+        self.defs = format_defs(self.frame_sources, self.frame_patterns, self.frame_glyphs)
+        # evicted images are deleted once the frame is drawn
+        self.write('}}, [{0}], {{{1}}}, [{2}]);\n'.format(
+            ', '.join(str(image_id) for image_id in self.frame_images),
+            self.defs,
+            ', '.join(str(image_id) for image_id in self.frame_deleted)))
+        self.out.write(self.footer)
+
+    def report(self):
+        if self.decimate:
+            print('{0}: {1} polyline points in, {2} out'.format(
+                self.filename, self.stats['points_in'],
+                self.stats['points_out']))
+        print('{0}: image cache {1}'.format(self.filename, self.image_cache.report()))
 
     def text(self, xst, yst, n, text):
 
         tx_font = self.gkss.txfont if self.gkss.asf[6] else predef_font[self.gkss.tindex - 1]
         tx_prec = self.gkss.txprec if self.gkss.asf[6] else predef_prec[self.gkss.tindex - 1]
         tx_color = self.gkss.txcoli if self.gkss.asf[9] else 1
-        color = self.p.rgb[tx_color]
-        color.append(self.transparency)
+        color = self.style(tx_color)
+        self.fill_color = color
 
         if self.gkss.version > 4:
             ln_width = round((self.p.width + self.p.height) * 0.001)
@@ -155,20 +706,182 @@ class Html_output(object):
             ln_width = 1
         if self.p.fillStyle != color:
             self.p.fillStyle = color
-            self.write('c.fillStyle="rgba({0},{1},{2},{3})";\n'.format(*color))
+            self.write('c.fillStyle="{0}";\n'.format(color))
         if self.p.strokeStyle != color:
             self.p.strokeStyle = color
-            self.write('c.strokeStyle="rgba({0},{1},{2},{3})";\n'.format(*color))
+            self.write('c.strokeStyle="{0}";\n'.format(color))
         if tx_prec == GKS_K_TEXT_PRECISION_STRING:
             self.set_font(tx_font)
             (x, y) = self.WC_to_NDC(xst, yst, self.gkss.cntnr)
             (x, y) = self.seg_xform(x, y)
             self.text_routine(x, y, n, text)
         else:
-            gks.emul_text(xst, yst, text)
+            self.emul_text(xst, yst, text)
+
+    def emul_text(self, xst, yst, text):
+        ''' lay out stroke text like gks_emul_text, using cached glyph paths '''
+        chars = [ch - 256 if ch > 127 else ch for ch in bytearray(text)]
+        (xn, yn) = self.WC_to_NDC(xst, yst, self.gkss.cntnr)
+
+        font = self.gkss.txfont
+        prec = self.gkss.txprec
+        if prec != GKS_K_TEXT_PRECISION_STROKE:
+            font = map_font(font)
+
+        self.set_chr_xform()
+        (txx, size, bottom, base, cap, top) = self.text_extent(chars, font, prec)
+
+        space = int(self.gkss.chsp * size + 0.5)
+        txx += len(chars) * space
+
+        (alh, alv) = self.gkss.txal
+        path = self.gkss.txp
+        if path == GKS_K_TEXT_PATH_UP or path == GKS_K_TEXT_PATH_DOWN:
+            txx = size
+
+        if alh == GKS_K_TEXT_HALIGN_CENTER:
+            ax = -0.5 * txx
+        elif alh == GKS_K_TEXT_HALIGN_RIGHT:
+            ax = -txx
+        else:
+            ax = 0
+
+        if path == GKS_K_TEXT_PATH_LEFT:
+            (txx, size, bottom, base, cap, top) = self.text_extent(chars[:1], font, prec)
+            ax = -ax - txx
+
+        if alv == GKS_K_TEXT_VALIGN_TOP:
+            ay = base - top
+        elif alv == GKS_K_TEXT_VALIGN_CAP:
+            ay = base - cap
+        elif alv == GKS_K_TEXT_VALIGN_HALF:
+            ay = (base - cap) * 0.5
+        elif alv == GKS_K_TEXT_VALIGN_BOTTOM:
+            ay = base - bottom
+        else:
+            ay = 0
+
+        (ax, ay) = self.chr_xform(ax, ay, size)
+        xn += ax
+        yn += ay
+
+        rect = self.visible_rect(self.p.lineWidth or 1) if self.cull else None
+        placements = []
+        for ch in chars:
+            (txx, size, bottom, base, cap, top) = self.text_extent([ch], font, prec)
+            spacex = (txx + space) * xfac[path]
+            spacey = (top - bottom + space) * yfac[path]
+            (spacex, spacey) = self.chr_xform(spacex, spacey, size)
+
+            glyph_size = gks.lookup_font(self.gkss.fontfile, self.gkss.version, font, ch).size
+            (bx, by, ux, uy) = self.chr_xform_matrix(glyph_size)
+            ((m11, m12, m13), (m21, m22, m23), _) = mat_mul(
+                self.xform(0), ((bx, ux, xn), (by, uy, yn), (0, 0, 1)))
+            # outlines stay within about one character size of their origin
+            margin = 2 * glyph_size * (abs(m11) + abs(m12) + abs(m21) + abs(m22))
+            if rect is None or inside(rect, m13, m23, margin):
+                glyph_id = self.glyph(font, ch)
+            else:
+                glyph_id = None
+            if glyph_id is not None:
+                placements.append('[{0}, {1:.6g}, {2:.6g}, {3:.6g}, {4:.6g}, {5:.6g}, {6:.6g}]'.format(
+                    glyph_id, m11, m21, m12, m22, m13, m23))
+
+            xn += spacex
+            yn += spacey
+
+        if not placements:
+            return
+        if self.p.dashes != []:
+            self.p.dashes = []
+            self.write('set_dashes(c, []);\n')
+        self.write('draw_glyphs(c, [{0}], {1});\n'.format(
+            ', '.join(placements), 'true' if font == -51 else 'false'))
+
+    def set_chr_xform(self):
+        ''' compute the character base and up vectors like gks_set_chr_xform '''
+        (chux, chuy) = self.gkss.chup
+        chh = self.gkss.chh
+        scale = sqrt(chux * chux + chuy * chuy)
+        chux /= scale
+        chuy /= scale
+
+        (ux, uy) = self.WC_to_NDC_rel(chux * chh, chuy * chh, self.gkss.cntnr)
+        (bx, by) = self.WC_to_NDC_rel(chuy * chh, -chux * chh, self.gkss.cntnr)
+        rad = -self.gkss.txslant / 180.0 * pi
+        self.chr = (bx * self.gkss.chxp, by * self.gkss.chxp, ux, uy, cos(rad), sin(rad))
+
+    def chr_xform(self, x, y, size):
+        (bx, by, ux, uy, cos_f, sin_f) = self.chr
+        xn = x / float(size)
+        yn = y / float(size)
+        xn = cos_f * xn - sin_f * yn
+        yn = cos_f * yn
+        return (bx * xn + ux * yn, by * xn + uy * yn)
+
+    def chr_xform_matrix(self, size):
+        ''' return chr_xform as a linear map (bx', by', ux', uy') '''
+        (bx, by, ux, uy, cos_f, sin_f) = self.chr
+        return (bx * cos_f / size, by * cos_f / size,
+                (ux * cos_f - bx * sin_f) / size, (uy * cos_f - by * sin_f) / size)
+
+    def text_extent(self, chars, font, prec):
+        ''' return (txx, size, bottom, base, cap, top) like inq_text_extent '''
+        fd = self.gkss.fontfile
+        version = self.gkss.version
+        txx = 0
+        if prec == GKS_K_TEXT_PRECISION_STROKE:
+            s = gks.lookup_font(fd, version, font, ord(' '))
+            for ch in chars:
+                s = gks.lookup_font(fd, version, font, ch)
+                txx += s.right - s.left if ch != ord(' ') else s.size // 2
+        else:
+            s = gks.lookup_afm(font, ord(' '))
+            for ch in chars:
+                s = gks.lookup_afm(font, ch)
+                txx += s.right - s.left
+        return (txx, s.size, s.bottom, s.base, s.cap, s.top)
+
+    def glyph(self, font, ch):
+        ''' return the client-side id of a glyph outline, None if it is empty
+
+        The outline is sent in font units relative to the character origin,
+        once per page or once per channel in live mode.
+        '''
+        key = (self.gkss.version, font, ch)
+        if key in self.glyphs:
+            return self.glyphs[key]
+
+        s = gks.lookup_font(self.gkss.fontfile, self.gkss.version, font, ch)
+        subpaths = []
+        points = []
+        for i in range(s.length):
+            (xc, yc) = s.coord[i]
+            if xc > 127:
+                xc -= 256
+            if xc < 0:
+                if len(points) > 2:
+                    subpaths.append(points)
+                    points = []
+                xc = -xc
+            if s.left == s.right:
+                xc += s.size // 2
+            points.extend((xc - s.left, yc - s.base))
+        if len(points) > 2:
+            subpaths.append(points)
+
+        glyph_id = len(self.glyphs) if subpaths else None
+        self.glyphs[key] = glyph_id
+        if subpaths:
+            self.frame_glyphs.append((glyph_id, subpaths))
+        return glyph_id
 
     def text_routine(self, x, y, nchars, text):
+        if isinstance(text, bytes):
+            text = text.decode('latin-1')
         (xs, ys) = self.NDC_to_DC(x, y)
+        if self.cull and not inside(self.visible_rect(), xs, ys, 2 * (nchars + 1) * self.p.capheight):
+            return
 
         halign = self.gkss.txal[0]
         valign = self.gkss.txal[1]
@@ -213,17 +926,48 @@ class Html_output(object):
     def draw_image(self, xmin, xmax, ymin, ymax, dx, dy, dimx, colia):
         self.image_routine(xmin, xmax, ymin, ymax, dx, dy, dimx, colia, True)
 
-    def write_png(self, buf, width, height):
-        width_byte_4 = width * 4
-        raw_data = b"".join(b'\x00' + bytes(bytearray(buf[span:span + width_byte_4])) for span in range(0, height * width * 4, width_byte_4))
+    def write_png(self, buf, width, height, palette=None):
+        if palette is None:
+            (color_type, bpp) = (6, 4)
+        else:
+            (color_type, bpp) = (3, 1)
+        width_byte_4 = width * bpp
+        if numpy is not None and isinstance(buf, numpy.ndarray):
+            rows = buf.reshape(height, width_byte_4)
+            if palette is None and self.png_filter == 'adaptive':
+                raw_data = filter_rows(rows, bpp)
+            else:
+                raw_data = numpy.hstack((numpy.zeros((height, 1), dtype=numpy.uint8), rows)).tobytes()
+        else:
+            raw_data = b"".join(b'\x00' + bytes(bytearray(buf[span:span + width_byte_4])) for span in range(0, height * width_byte_4, width_byte_4))
         def png_pack(png_tag, data):
             chunk_head = png_tag + data
             return struct.pack("!I", len(data)) + chunk_head + struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk_head))
-        return b"".join([
+        chunks = [
             b'\x89PNG\r\n\x1a\n',
-            png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, 6, 0, 0, 0)),
-            png_pack(b'IDAT', zlib.compress(raw_data, 9)),
-            png_pack(b'IEND', b'')])
+            png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, color_type, 0, 0, 0))]
+        if palette is not None:
+            chunks.append(png_pack(b'PLTE', palette[:, :3].tobytes()))
+            opaque = numpy.flatnonzero(palette[:, 3] != 255)
+            if len(opaque):
+                chunks.append(png_pack(b'tRNS', palette[:opaque[-1] + 1, 3].tobytes()))
+        chunks.append(png_pack(b'IDAT', zlib.compress(raw_data, self.png_level)))
+        chunks.append(png_pack(b'IEND', b''))
+        return b"".join(chunks)
+
+    def write_indexed_png(self, cells, width, height):
+        ''' encode color indices as a palette PNG if they use at most 256 colors '''
+        alpha = int(self.transparency * 255)
+        lut = numpy.array([rgb[:3] + (alpha,) for rgb in self.p.rgb], dtype=numpy.uint8)
+        (colors, color_ids) = numpy.unique(lut.view('<u4').ravel(), return_inverse=True)
+        ids = color_ids.ravel().take(cells)
+        used = numpy.flatnonzero(numpy.bincount(ids.ravel(), minlength=len(colors)))
+        if len(used) > 256:
+            return self.write_png(lut.take(cells, axis=0), width, height)
+        palette_ids = numpy.zeros(len(colors), dtype=numpy.uint8)
+        palette_ids[used] = numpy.arange(len(used))
+        return self.write_png(palette_ids.take(ids), width, height,
+                              colors[used].view(numpy.uint8).reshape(-1, 4))
 
     def image_routine(self, xmin, xmax, ymin, ymax, dx, dy, dimx, colia, true_color):
         (x1, y1) = self.WC_to_NDC(xmin, ymax, self.gkss.cntnr)
@@ -234,8 +978,6 @@ class Html_output(object):
         (x2, y2) = self.seg_xform(x2, y2)
         (ix2, iy2) = self.NDC_to_DC(x2, y2)
 
-        pix_buf = []
-
         ix1 = int(ix1)
         iy1 = int(iy1)
         ix2 = int(ix2)
@@ -248,16 +990,73 @@ class Html_output(object):
 
         x = min(ix1, ix2)
         y = min(iy1, iy2)
+        if self.cull and not overlaps((x, x + width, y, y + height), self.visible_rect()):
+            return
 
         swapx = ix1 > ix2
         swapy = iy1 < iy2
 
+        key = self.image_key(dx, dy, dimx, colia, width, height, swapx, swapy, true_color)
+        entry = self.image_cache.lookup(key)
+        if entry is None:
+            if numpy is None:
+                pix_buf = self.resample_loop(dx, dy, dimx, colia, width, height,
+                                             swapx, swapy, true_color)
+                png = self.write_png(pix_buf, width, height)
+            elif true_color:
+                cells = self.resample(dx, dy, dimx, colia, width, height, swapx, swapy)
+                # packed colors are stored as 0xAABBGGRR
+                png = self.write_png(cells.astype('<u4').view(numpy.uint8), width, height)
+            else:
+                cells = self.resample(dx, dy, dimx, colia, width, height, swapx, swapy)
+                png = self.write_indexed_png(cells, width, height)
+
+            enc_png = base64.b64encode(png).decode('ascii')
+            data_uri = 'data:image/png;base64, {0}'.format(enc_png)
+            entry = self.image_cache.store(key, data_uri)
+
+        (image_id, data_uri) = entry
+        self.frame_deleted.extend(self.image_cache.evicted)
+        del self.image_cache.evicted[:]
+        if image_id not in self.sent_images:
+            self.sent_images.add(image_id)
+            self.frame_sources.append(entry)
+        if image_id not in self.frame_images:
+            self.frame_images.append(image_id)
+        self.write('c.drawImage(images[{0}], {1}, {2});\n'.format(image_id, x, y))
+
+    def image_key(self, dx, dy, dimx, colia, width, height, swapx, swapy, true_color):
+        ''' hash everything that determines the pixels of an image '''
+        key = hashlib.sha1(struct.pack('=8i', dx, dy, dimx, width, height,
+                                       swapx, swapy, true_color))
+        if numpy is not None and isinstance(colia, numpy.ndarray):
+            key.update(numpy.ascontiguousarray(colia, dtype=numpy.int32).tobytes())
+        else:
+            key.update(struct.pack('=%di' % len(colia), *colia))
+        if not true_color:
+            key.update(repr((self.transparency, [rgb[:3] for rgb in self.p.rgb])).encode('ascii'))
+        return key.digest()
+
+    def resample(self, dx, dy, dimx, colia, width, height, swapx, swapy):
+        ''' nearest-neighbour resample a cell array to device pixels '''
+        iy = numpy.arange(height) * dy // height
+        ix = numpy.arange(width) * dx // width
+        if swapy:
+            iy = dy - 1 - iy
+        if swapx:
+            ix = dx - 1 - ix
+        return numpy.asarray(colia)[(iy * dimx)[:, None] + ix]
+
+    def resample_loop(self, dx, dy, dimx, colia, width, height, swapx, swapy, true_color):
+        pix_buf = []
+        colia = as_list(colia)
+
         for j in range(height):
-            iy = dy * j / height
+            iy = dy * j // height
             if swapy:
                 iy = dy - 1 - iy
             for i in range(width):
-                ix = dx * i / width
+                ix = dx * i // width
                 if swapx:
                     ix = dx - 1 - ix
                 if not true_color:
@@ -276,18 +1075,7 @@ class Html_output(object):
                 pix_buf.append(blue)
                 pix_buf.append(alpha)
 
-        png = self.write_png(pix_buf, width, height)
-
-        import base64
-        enc_png = base64.b64encode(png)
-        data_uri = 'data:image/png;base64, {0}'.format(enc_png)
-        self.write('var imageObj = new Image();\n')
-        self.write('imageObj.onload = function() {\n')
-        self.indentation += 1
-        self.write('c.drawImage(this, {0}, {1});\n'.format(x, y))
-
-        self.footer = (self.indentation - 1) * '  ' + 'imageObj.src = "{0}";\n'.format(data_uri) + self.footer
-        self.footer = (self.indentation - 1) * '  ' + '};\n' + self.footer
+        return pix_buf
 
     def fillarea(self, n, px, py):
         fl_color = self.gkss.facoli if self.gkss.asf[12] else 1
@@ -295,59 +1083,61 @@ class Html_output(object):
         if self.p.lineWidth != ln_width:
             self.p.lineWidth = ln_width
             self.write('c.lineWidth = {0};\n'.format(ln_width))
-        color = self.p.rgb[fl_color]
-        color.append(self.transparency)
-        if self.p.fillStyle != color:
-            self.p.fillStyle = color
-            self.write('c.fillStyle="rgba({0},{1},{2},{3})";\n'.format(*color))
+        self.fill_color = self.style(fl_color)
         self.fill_routine(n, px, py, self.gkss.cntnr)
 
     def fill_routine(self, n, px, py, tnr):
-        self.write('c.beginPath();\n')
-
-        if self.p.dashes != []:
-            self.p.dashes = []
-            self.write('set_dashes(c, []);\n')
-
-        (xn, yn) = self.WC_to_NDC(px[0], py[0], self.gkss.cntnr)
-        (xn, yn) = self.seg_xform(xn, yn)
-        (xd, yd) = self.NDC_to_DC(xn, yn)
-        self.write('c.moveTo({0}, {1});\n'.format(xd, yd))
-        for i in range(1, n):
-            (xn, yn) = self.WC_to_NDC(px[i], py[i], self.gkss.cntnr)
-            (xn, yn) = self.seg_xform(xn, yn)
-            (xd, yd) = self.NDC_to_DC(xn, yn)
-            self.write('c.lineTo({0}, {1});\n'.format(xd, yd))
-        self.write('c.closePath();\n')
-
+        (xd, yd) = self.WC_to_DC(n, px, py, self.gkss.cntnr)
+        extent = bounds(xd, yd)
+        if self.cull and not overlaps(extent, self.visible_rect(self.p.lineWidth or 1)):
+            return
         fl_inter = self.gkss.ints if self.gkss.asf[10] else predef_ints[self.gkss.findex - 1]
-        if fl_inter == GKS_K_INTSTYLE_PATTERN or fl_inter == GKS_K_INTSTYLE_HATCH:
+        if fl_inter == GKS_K_INTSTYLE_SOLID:
+            style = self.fill_color
+        elif fl_inter == GKS_K_INTSTYLE_PATTERN or fl_inter == GKS_K_INTSTYLE_HATCH:
             fl_style = self.gkss.styli if self.gkss.asf[11] else predef_styli[self.gkss.findex - 1]
             if fl_inter == GKS_K_INTSTYLE_HATCH:
                 fl_style += HATCH_STYLE
             if fl_style >= PATTERNS:
                 fl_style = 1
-            pattern = gks.inq_pattern_array(fl_style)
-            self.write('var pcan = document.createElement("canvas");\n')
-            self.write('pcan.width = 8;\n')
-            self.write('pcan.height = {0};\n'.format(len(pattern)))
-            self.write('var pctx = pcan.getContext("2d");\n')
-            if self.p.fillStyle != [0, 0, 0]:
-                self.write('c.fillStyle="rgba({0},{1},{2},{3})";\n'.format(*self.p.fillStyle))
-            for j in range(len(pattern)):
-                for i in range(8):
-                    a = (1 << i) & pattern[j]
-                    if not a:
-                        self.write(
-                            'pctx.rect({0}, {1}, 1, 1);\n'.format((i + 7) % 8, (j + (len(pattern) - 1)) % len(pattern)))
-            self.write('pctx.fill();\n')
-            self.write('var pattern = c.createPattern(pcan, "repeat");\n')
-            self.write('c.fillStyle = pattern;\n')
-            self.write('c.fill();\n')
-        elif fl_inter == GKS_K_INTSTYLE_SOLID:
-            self.write('c.fill();\n')
+            style = self.pattern(fl_style, self.fill_color)
+        else:
+            style = None
+        if style is not None:
+            key = ('fill', style)
         else:
-            self.write('c.stroke();\n')
+            key = ('stroke', self.p.strokeStyle, self.p.lineWidth, ())
+            extent = None
+
+        if not self.continue_path(key, extent):
+            if style is not None and self.p.fillStyle != style:
+                self.p.fillStyle = style
+                if fl_inter == GKS_K_INTSTYLE_SOLID:
+                    self.write('c.fillStyle="{0}";\n'.format(style))
+                else:
+                    self.write('c.fillStyle = {0};\n'.format(style))
+            self.write('c.beginPath();\n')
+            if self.p.dashes != []:
+                self.p.dashes = []
+                self.write('set_dashes(c, []);\n')
+
+        self.write_path(xd, yd)
+        self.out.write('c.closePath();\n', self.indentation)
+
+        self.end_path(key, extent)
+
+    def pattern(self, fl_style, color):
+        ''' return the client-side name of a fill pattern in the given color
+
+        Patterns are created once per page, or once per channel in live mode.
+        '''
+        key = (fl_style, color)
+        pattern_id = self.patterns.get(key)
+        if pattern_id is None:
+            pattern_id = len(self.patterns)
+            self.patterns[key] = pattern_id
+            self.frame_patterns.append((pattern_id, gks.inq_pattern_array(fl_style), color))
+        return 'patterns[{0}]'.format(pattern_id)
 
     def set_window(self, tnr, xmin, xmax, ymin, ymax):
         self.gkss.window[tnr][0] = xmin
@@ -384,44 +1174,95 @@ class Html_output(object):
             ln_color = 1
         ln_width = max(1, round(ln_width))
 
-        color = self.p.rgb[ln_color]
-        color.append(self.transparency)
+        dashes = gks.get_dash_list(ln_type, ln_width)
+        (xd, yd) = self.WC_to_DC(n, px, py, self.gkss.cntnr)
+        if self.cull:
+            # leave room for miter joins, which canvas limits to 5 line widths
+            rect = self.visible_rect(5 * ln_width)
+            if dashes:
+                # trimming would shift the dash pattern
+                spans = [(0, n)] if overlaps(bounds(xd, yd), rect) else []
+            else:
+                spans = visible_spans(xd, yd, rect)
+            if not spans:
+                return
+        else:
+            spans = [(0, n)]
+
+        color = self.style(ln_color)
         if self.p.strokeStyle != color:
             self.p.strokeStyle = color
-            self.write('c.strokeStyle="rgba({0},{1},{2},{3})";\n'.format(*color))
+            self.write('c.strokeStyle="{0}";\n'.format(color))
         if self.p.lineWidth != ln_width:
             self.p.lineWidth = ln_width
             self.write('c.lineWidth = {0};\n'.format(ln_width))
 
-        self.write('c.beginPath();\n')
-        dashes = gks.get_dash_list(ln_type, ln_width)
-        if self.p.dashes != dashes:
-            self.p.dashes = dashes
-            self.write('set_dashes(c, {0});\n'.format(str(dashes)))
-
-        (xn, yn) = self.WC_to_NDC(px[0], py[0], self.gkss.cntnr)
-        (xn, yn) = self.seg_xform(xn, yn)
-        (xd, yd) = self.NDC_to_DC(xn, yn)
-        self.write('c.moveTo({0}, {1});\n'.format(xd, yd))
-        for i in range(1, n):
-            (xn, yn) = self.WC_to_NDC(px[i], py[i], self.gkss.cntnr)
-            (xn, yn) = self.seg_xform(xn, yn)
-            (xd, yd) = self.NDC_to_DC(xn, yn)
-            self.write('c.lineTo({0}, {1});\n'.format(xd, yd))
-        self.write('c.stroke();\n')
+        key = ('stroke', color, ln_width, tuple(dashes))
+        if not self.continue_path(key):
+            self.write('c.beginPath();\n')
+            if self.p.dashes != dashes:
+                self.p.dashes = dashes
+                self.write('set_dashes(c, {0});\n'.format(str(dashes)))
+
+        for (start, stop) in spans:
+            (x, y) = (xd[start:stop], yd[start:stop])
+            if self.decimate and not dashes and stop - start > 2:
+                self.stats['points_in'] += stop - start
+                if is_monotonic(x):
+                    (x, y) = decimate_columns(x, y)
+                else:
+                    (x, y) = simplify(x, y, self.tolerance)
+                self.stats['points_out'] += len(x)
+            self.write_path(x, y)
+        self.end_path(key)
+
+    def write_path(self, xd, yd):
+        # subpaths may extend a pending path, so bypass the flush in write()
+        write = self.out.write
+        level = self.indentation
+        if self.path_encoding != 'text':
+            (array_type, points) = encode_points(
+                xd, yd, self.path_encoding == 'int16')
+            write('add_path(c, {0}, "{1}");\n'.format(array_type, points), level)
+            return
+        xd = as_list(xd)
+        yd = as_list(yd)
+        write('c.moveTo({0}, {1});\n'.format(xd[0], yd[0]), level)
+        for i in range(1, len(xd)):
+            write('c.lineTo({0}, {1});\n'.format(xd[i], yd[i]), level)
+
+    def continue_path(self, key, extent=None):
+        ''' check whether a primitive with the given style key can be added
+            to the pending path, flush the pending path if it cannot
+        '''
+        path = self.path
+        if path is not None and path[0] == key and len(path[1]) < MAX_SUBPATHS:
+            if extent is None or not any(overlaps(extent, e) for e in path[1]):
+                return True
+        self.flush_path()
+        return False
+
+    def end_path(self, key, extent=None):
+        if not self.batch_paths or self.transparency < 1:
+            self.write(path_ends[key[0]])
+        elif self.path is None:
+            self.path = (key, [extent])
+        else:
+            self.path[1].append(extent)
 
-    def line_routine(self, n, px, py, ltype, tnr):
-        (xn, yn) = self.WC_to_NDC(px[0], py[0], self.gkss.cntnr)
-        (xn, yn) = self.seg_xform(xn, yn)
-        (xd, yd) = self.NDC_to_DC(xn, yn)
-        self.write('c.beginPath();\n')
-        self.write('c.moveTo({0}, {1});\n'.format(xd, yd))
-        for i in range(1, n):
-            (xn, yn) = self.WC_to_NDC(px[i], py[i], self.gkss.cntnr)
-            (xn, yn) = self.seg_xform(xn, yn)
-            (xd, yd) = self.NDC_to_DC(xn, yn)
-            self.write('c.lineTo({0}, {1});\n'.format(xd, yd))
-        self.write('c.stroke();\n')
+    def flush_path(self):
+        if self.path is None:
+            return
+        (key, items) = self.path
+        self.path = None
+        if key[0] == 'sprite':
+            xd = concat([xd for (xd, yd) in items])
+            yd = concat([yd for (xd, yd) in items])
+            (array_type, points) = encode_points(xd, yd, True)
+            self.write('draw_sprites(c, {0}, {1}, "{2}");\n'.format(
+                key[1], array_type, points))
+        else:
+            self.write(path_ends[key[0]])
 
     def init_canvas(self):
         self.write('var canvas=document.getElementById("html-canvas");\n')
@@ -436,200 +1277,76 @@ class Html_output(object):
         self.write('c.lineTo({0}, {1});\n'.format(x2, y2))
         self.write('c.stroke();\n')
 
-    def draw_marker(self, xn, yn, mtype, mscale, mcolor):
-        marker = [
-            # omark
-            [ 5, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
-              -700, -400, -700, 400, -400, 700,
-              3, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
-              -700, -400, -700, 400, -400, 700, 0 ],
-            # hline
-            [ 2, -1000, 0, 1000, 0, 0 ],
-            # vline
-            [ 2, 0, -1000, 0, 1000, 0 ],
-            # star8
-            [ 4, 16,  0, -1000, 153, -370, 707, -707, 370, -153, 1000, 0, 370, 153,
-              707, 707, 153, 370, 0, 1000, -153, 370, -707, 707, -370, 153, -1000, 0,
-              -370, -153, -707, -707, -153, -370, 0 ],
-            # star7
-            [ 4, 14,  0, 1000, 174, 360, 782, 623, 390, 89, 975, -223, 313, -249,
-              434, -901, 0, -400, -434, -901, -313, -249, -975, -223, -390, 89,
-              -782, 623, -174, 360, 0 ],
-            # star6
-            [ 4, 12,  0, -1000, 200, -346, 866, -500, 400, 0, 866, 500, 200, 346, 0,
-              1000, -200, 346, -866, 500, -400, 0, -866, -500, -200, -346, 0 ],
-            # star5
-            [ 4, 10,  0, 1000, 235, 324, 951, 309, 380, -124, 588, -809, 0, -400,
-              -588, -809, -380, -124, -951, 309, -235, 324, 0 ],
-            # star4
-            [ 4, 8,  0, -1000, 283, -283, 1000, 0, 283, 283, 0, 1000, -283, 283,
-              -1000, 0, -283, -283, 0 ],
-            # octagon
-            [ 4, 8,  0, -1000, 707, -707, 1000, 0, 707, 707, 0, 1000, -707, 707,
-              -1000, 0, -707, -707, 0 ],
-            # heptagon
-            [ 4, 7,  0, 1000, 782, 623, 975, -223, 434, -901, -434, -901,
-              -975, -223, -782, 623, 0 ],
-            # hexagon
-            [ 4, 6,  0, -1000, 866, -500, 866, 500, 0, 1000, -866, 500, -866, -500,
-              0 ],
-            # pentagon
-            [ 4, 5,  0, 1000, 951, 309, 588, -809, -588, -809, -951, 309, 0 ],
-            # omark
-            [ 5, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
-              -700, -400, -700, 400, -400, 700,
-              3, 9, -400, 700, 400, 700, 700, 400, 700, -400, 400, -700, -400, -700,
-              -700, -400, -700, 400, -400, 700, 0 ],
-            # hollow plus
-            [ 5, 13, -200, 800, 200, 800, 200, 200, 800, 200, 800, -200, 200, -200,
-              200, -800, -200, -800, -200, -200, -800, -200, -800, 200, -200, 200,
-              -200, 800,
-              3, 13, -200, 800, 200, 800, 200, 200, 800, 200, 800, -200, 200, -200,
-              200, -800, -200, -800, -200, -200, -800, -200, -800, 200, -200, 200,
-              -200, 800, 0 ],
-            # solid triangle right
-            [ 4, 4, -800, 0, 400, 700, 400, -700, -800, 0, 0 ],
-            # solid triangle left
-            [ 4, 4, 800, 0, -400, -700, -400, 700, 800, 0, 0 ],
-            # triangle up down
-            [ 5, 4, 0, 800, 700, -400, -700, -400, 0, 800,
-              5, 4, 0, -800, -700, 400, 700, 400, 0, -800,
-              3, 4, 0, 800, 700, -400, -700, -400, 0, 800,
-              3, 4, 0, -800, -700, 400, 700, 400, 0, -800, 0 ],
-            # solid star
-            [ 4, 11, 0, 900, 200, 200, 900, 300, 300, -100, 600, -800, 0, -300,
-              -600, -800, -300, -100, -900, 300, -200, 200, 0, 900, 0 ],
-            # hollow star
-            [ 5, 11, 0, 900, 200, 200, 900, 300, 300, -100, 600, -800, 0, -300,
-              -600, -800, -300, -100, -900, 300, -200, 200, 0, 900,
-              3, 11, 0, 900, 200, 200, 900, 300, 300, -100, 600, -800, 0, -300,
-              -600, -800, -300, -100, -900, 300, -200, 200, 0, 900, 0 ],
-            # solid diamond
-            [ 4, 5, 0, 1000, 1000, 0, 0, -1000, -1000, 0, 0, 1000, 0],
-            # hollow diamond
-            [ 5, 5, 0, 1000, 1000, 0, 0, -1000, -1000, 0, 0, 1000,
-              3, 5, 0, 1000, 1000, 0, 0, -1000, -1000, 0, 0, 1000, 0 ],
-            # solid hourglass
-            [ 4, 5, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 1000, 0 ],
-            # hollow hourglass
-            [ 5, 5, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 1000,
-              3, 5, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 1000, 0 ],
-            # solid bowtie
-            [ 4, 5, 1000, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 0 ],
-            # hollow bowtie
-            [ 5, 5, 1000, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000,
-              3, 5, 1000, 1000, 1000, -1000, -1000, 1000, -1000, -1000, 1000, 1000, 0 ],
-            # solid square
-            [ 4, 5, 1000, 1000, 1000, -1000, -1000, -1000, -1000, 1000, 1000, 1000, 0 ],
-            # hollow square
-            [ 5, 5, 1000, 1000, 1000, -1000, -1000, -1000, -1000, 1000, 1000, 1000,
-              3, 5, 1000, 1000, 1000, -1000, -1000, -1000, -1000, 1000, 1000, 1000, 0 ],
-            # solid triangle down
-            [ 4, 4, -1000, 1000, 1000, 1000, 0, -1000, -1000, 1000, 0 ],
-            # hollow triangle down
-            [ 5, 4, -1000, 1000, 1000, 1000, 0, -1000, -1000, 1000,
-              3, 4, -1000, 1000, 1000, 1000, 0, -1000, -1000, 1000, 0 ],
-            # solid triangle up
-            [ 4, 4, 0, 1000, 1000, -1000, -1000, -1000, 0, 1000, 0 ],
-            # hollow triangle up
-            [ 5, 4, 0, 1000, 1000, -1000, -1000, -1000, 0, 1000,
-              3, 4, 0, 1000, 1000, -1000, -1000, -1000, 0, 1000, 0 ],
-            # solid circle
-            [ 7, 0, 360, 0 ],
-            # not used
-            [ 0 ],
-            # dot
-            [ 1, 0 ],
-            # plus
-            [ 2, 0, 0, 0, 1000, 2, 0, 0, 1000, 0, 2, 0, 0, 0, -1000,
-              2, 0, 0, -1000, 0, 0 ],
-            # asterisk
-            [ 2, 0, 0, 0, 1000, 2, 0, 0, 1000, 300,
-              2, 0, 0, 600, -1000, 2, 0, 0, -600, -1000,
-              2, 0, 0, -1000, 300, 0 ],
-            # circle
-            [ 8, 6, 0 ],
-            # diagonal cross
-            [ 2, 0, 0, 1000, 1000, 2, 0, 0, 1000, -1000,
-              2, 0, 0, -1000, -1000, 2, 0, 0, -1000, 1000, 0 ]
-          ]
-
-        if self.gkss.version > 4:
-            mscale *= (self.p.width + self.p.height) * 0.001
-        r = int(3 * mscale)
-        scale = 0.01 * mscale / 3.0
-
-        xr = r
-        yr = 0
-        (xr, yr) = self.seg_xform_rel(xr, yr)
-        r = round(sqrt(xr * xr + yr * yr))
-
-        (x, y) = self.NDC_to_DC(xn, yn)
-
-        pc = 0
-        mtype = mtype + 32 if (2 * r > 1) else 33
-        while (True):
-            op = marker[mtype][pc]
+    def marker_shape(self, mtype, r, scale):
+        ''' return the operations of marker mtype relative to its center '''
+        shape = []
+        for (op, args) in marker_ops[mtype]:
+            if op in (2, 3, 4, 5):
+                points = [self.seg_xform_rel(scale * args[i], scale * args[i + 1])
+                          for i in range(0, len(args), 2)]
+                shape.append((op, tuple(points)))
+            else:
+                shape.append((op, ()))
+        return tuple(shape)
+
+    def draw_marker(self, x, y, shape, r, color):
+        for (op, args) in shape:
             if op == 1:  # point
                 self.draw_point(x, y)
             elif op == 2:  # line
-                x1 = scale * marker[mtype][pc + 1]
-                y1 = scale * marker[mtype][pc + 2]
-                (x1, y1) = self.seg_xform_rel(x1, y1)
-
-                x2 = scale * marker[mtype][pc + 2 + 1]
-                y2 = scale * marker[mtype][pc + 2 + 2]
-                (x2, y2) = self.seg_xform_rel(x2, y2)
-
+                ((x1, y1), (x2, y2)) = args
                 self.draw_line(x - x1, y - y1, x - x2, y - y2)
-                pc += 4
-
             elif op in (3, 4, 5):  # 3 - polygon   4 - filled polygon   5 - hollow polygon
-                xr = scale * marker[mtype][pc + 2]
-                yr = scale * marker[mtype][pc + 3]
-                (xr, yr) = self.seg_xform_rel(xr, yr)
-
                 self.write('c.beginPath();\n')
-                self.write('c.moveTo({0}, {1});\n'.format(x - xr, y - yr))
-
-                for i in range(1, marker[mtype][pc + 1]):
-                    xr = scale * marker[mtype][pc + 2 + 2 * i]
-                    yr = scale * marker[mtype][pc + 3 + 2 * i]
-
-                    (xr, yr) = self.seg_xform_rel(xr, yr)
+                self.write('c.moveTo({0}, {1});\n'.format(x - args[0][0], y - args[0][1]))
+                for (xr, yr) in args[1:]:
                     self.write('c.lineTo({0}, {1});\n'.format(x - xr, y - yr))
-
                 self.write('c.closePath();\n')
 
                 if not op == 3:
                     if op == 5:
                         self.write('c.fillStyle = "#FFFFFF";\n')
-                    else:
-                        self.write('c.fillStyle = "#000000";\n')
                     self.write('c.fill();\n')
-                    self.write('c.fillStyle = "#000000";\n')
+                    if op == 5:
+                        self.write('c.fillStyle = "{0}";\n'.format(color))
                 else:
                     self.write('c.stroke();\n')
-
-                pc += 1 + 2 * marker[mtype][pc + 1]
             elif op in (6, 7, 8):  # 6 - arc   7 - filled arc   8 - hollow arc
-                center = (x, y)
-
-                start_angle = marker[mtype][pc + 1] * pi / 180
-                end_angle = marker[mtype][pc + 2] * pi / 180
-
                 self.write('c.beginPath();\n')
-                self.draw_arc(x, y, r, start_angle, end_angle)
+                self.draw_arc(x, y, r, 0, 2 * pi)
                 self.write('c.closePath();\n')
                 if not op == 6:
                     if op == 8:
                         self.write('c.fillStyle = "#FFFFFF";\n')
                     self.write('c.fill();\n')
-                    self.write('c.fillStyle = "#000000";\n')
-                pc += 2
-            pc += 1
-            if op == 0:
-                break
+                    if op == 8:
+                        self.write('c.fillStyle = "{0}";\n'.format(color))
+
+    def draw_sprites(self, xd, yd, shape, r, color, ln_width):
+        if len(xd) == 0:
+            return
+        key = (shape, r, color, ln_width)
+        if key not in self.sprites:
+            name = 'marker{0}'.format(len(self.sprites))
+            self.sprites[key] = name
+            half = int(shape_extent(shape, r)) + ln_width + 1
+            self.write('var {0} = make_sprite({1}, function(c) {{\n'.format(name, 2 * half))
+            self.indentation += 1
+            self.write('c.fillStyle = "{0}";\n'.format(color))
+            self.write('c.strokeStyle = "{0}";\n'.format(color))
+            self.write('c.lineWidth = {0};\n'.format(ln_width))
+            self.draw_marker(half, half, shape, r, color)
+            self.indentation -= 1
+            self.write('});\n')
+        key = ('sprite', self.sprites[key])
+        if self.batch_paths and self.continue_path(key):
+            self.path[1].append((xd, yd))
+        elif self.batch_paths:
+            self.path = (key, [(xd, yd)])
+        else:
+            (array_type, points) = encode_points(xd, yd, True)
+            self.write('draw_sprites(c, {0}, {1}, "{2}");\n'.format(
+                key[1], array_type, points))
 
     def set_fill_style_index(self, index):
         self.gkss.styli = index
@@ -670,25 +1387,41 @@ class Html_output(object):
         mk_type = self.gkss.mtype if self.gkss.asf[3] else self.gkss.mindex
         mk_size = self.gkss.mszsc if self.gkss.asf[4] else 1
         mk_color = self.gkss.pmcoli if self.gkss.asf[5] else 1
-        color = self.p.rgb[mk_color]
-        color.append(self.transparency)
+        style = self.style(mk_color)
+        ln_width = max(1, round((self.p.width + self.p.height) * 0.001)) if self.gkss.version > 4 else 1
 
-        if self.p.fillStyle != color:
-            self.p.fillStyle = color
-            self.write('c.fillStyle="rgba({0},{1},{2},{3})";\n'.format(*color))
-        if self.p.strokeStyle != color:
-            self.p.strokeStyle = color
-            self.write('c.strokeStyle="rgba({0},{1},{2},{3})";\n'.format(*color))
+        if self.gkss.version > 4:
+            mk_size *= (self.p.width + self.p.height) * 0.001
+        r = int(3 * mk_size)
+        scale = 0.01 * mk_size / 3.0
 
-        ln_width = max(1, round((self.p.width + self.p.height) * 0.001)) if self.gkss.version > 4 else 1
+        (xr, yr) = self.seg_xform_rel(r, 0)
+        r = round(sqrt(xr * xr + yr * yr))
+
+        mk_type = mk_type + 32 if (2 * r > 1) else 33
+        shape = self.marker_shape(mk_type, r, scale)
+
+        (xd, yd) = self.WC_to_DC(len(px), px, py, self.gkss.cntnr)
+        if self.cull:
+            (xd, yd) = points_inside(xd, yd, self.visible_rect(shape_extent(shape, r) + ln_width + 1))
+            if len(xd) == 0:
+                return
+        if self.marker_sprites:
+            self.draw_sprites(xd, yd, shape, r, style, ln_width)
+            return
+
+        if self.p.fillStyle != style:
+            self.p.fillStyle = style
+            self.write('c.fillStyle="{0}";\n'.format(style))
+        if self.p.strokeStyle != style:
+            self.p.strokeStyle = style
+            self.write('c.strokeStyle="{0}";\n'.format(style))
         if self.p.lineWidth != ln_width:
             self.p.lineWidth = ln_width
             self.write('c.lineWidth = {0};\n'.format(ln_width))
 
-        for i in range(len(px)):
-            (x, y) = self.WC_to_NDC(px[i], py[i], self.gkss.cntnr)
-            (x, y) = self.seg_xform(x, y)
-            self.draw_marker(x, y, mk_type, mk_size, 1)
+        for (x, y) in zip(as_list(xd), as_list(yd)):
+            self.draw_marker(x, y, shape, r, style)
 
     def seg_xform_rel(self, x, y):
         xx = x * self.gkss.mat[0][0] + y * self.gkss.mat[0][1]
@@ -705,18 +1438,29 @@ class Html_output(object):
         self.p.b = -self.p.window[0] * self.p.a
         self.p.c = (self.p.height - 1) / (self.p.window[2] - self.p.window[3])
         self.p.d = self.p.height - 1 - self.p.window[2] * self.p.c
+        self.xforms = [None for i in range(MAX_TNR)]
+        self.font_layouts.clear()
 
     def set_norm_xform(self, tnr, wn, vp):
         a[tnr] = (vp[1] - vp[0]) / (wn[1] - wn[0])
         b[tnr] = vp[0] - wn[0] * a[tnr]
         c[tnr] = (vp[3] - vp[2]) / (wn[3] - wn[2])
         d[tnr] = vp[2] - wn[2] * c[tnr]
+        self.xforms[tnr] = None
+        self.font_layouts.clear()
 
         (xp1, yp1) = self.NDC_to_DC(vp[0], vp[3])
         (xp2, yp2) = self.NDC_to_DC(vp[1], vp[2])
 
         self.p.rect[tnr] = ((xp1, yp1), (xp2, yp2))
 
+    def set_coord_xform(self, *mat):
+        for i in range(3):
+            self.gkss.mat[i][0] = mat[2 * i]
+            self.gkss.mat[i][1] = mat[2 * i + 1]
+        self.xforms = [None for i in range(MAX_TNR)]
+        self.font_layouts.clear()
+
     def set_text_fontprec(self, font, prec):
         self.gkss.txfont = font
         self.gkss.txprec = prec
@@ -732,10 +1476,12 @@ class Html_output(object):
 
     def set_text_height(self, h):
         self.gkss.chh = h
+        self.font_layouts.clear()
 
     def set_text_upvec(self, x, y):
         self.gkss.chup[0] = x
         self.gkss.chup[1] = y
+        self.font_layouts.clear()
 
     def set_text_path(self, path):
         self.gkss.txp = path
@@ -747,6 +1493,16 @@ class Html_output(object):
     def set_text_slant(self, slant):
         self.gkss.txslant = slant
 
+    def set_shadow(self, offsetx, offsety, blur):
+        # kept in the state list only, shadows are not drawn
+        self.gkss.shoff[0] = offsetx
+        self.gkss.shoff[1] = offsety
+        self.gkss.blur = blur
+
+    def gdp(self, n, px, py, primid, ldr, datrec):
+        # generalized drawing primitives are not supported by this output
+        pass
+
     def set_clipping(self, clip):
         self.gkss.clip = clip
         self.set_clip_rect(self.gkss.cntnr)
@@ -762,14 +1518,38 @@ class Html_output(object):
             self.p.clip_rect = self.p.rect[tnr]
             self.write('c.save();\n')
             self.write('c.beginPath();\n')
-            self.write('c.rect({}, {}, {}, {});\n'.format(self.p.clip_rect[0][0], self.p.clip_rect[0][1],
-                                                          self.p.clip_rect[1][0], self.p.clip_rect[1][1]))
+            ((x1, y1), (x2, y2)) = self.p.clip_rect
+            self.write('c.rect({}, {}, {}, {});\n'.format(x1, y1, x2 - x1, y2 - y1))
             self.write('c.clip();\n')
         else:
             self.p.clip_rect = ()
 
+    def visible_rect(self, margin=0):
+        ''' return the part (xmin, xmax, ymin, ymax) of the canvas that
+            drawing can reach, widened by margin
+        '''
+        (xmin, xmax, ymin, ymax) = (0, self.p.width, 0, self.p.height)
+        if self.p.clip_rect:
+            ((x1, y1), (x2, y2)) = self.p.clip_rect
+            xmin = max(xmin, min(x1, x2))
+            xmax = min(xmax, max(x1, x2))
+            ymin = max(ymin, min(y1, y2))
+            ymax = min(ymax, max(y1, y2))
+        return (xmin - margin, xmax + margin, ymin - margin, ymax + margin)
+
     def set_font(self, font):
+        key = (font, self.gkss.cntnr)
+        layout = self.font_layouts.get(key)
+        if layout is None:
+            layout = self.font_layouts[key] = self.font_layout(font)
+        (self.p.alpha, self.p.capheight, self.p.family, font_str) = layout
 
+        if self.p.font != font_str:
+            self.p.font = font_str
+            self.write('c.font = "{0}";\n'.format(font_str))
+
+    def font_layout(self, font):
+        ''' return the rotation, cap height, family and CSS font string of a font '''
         font = abs(font)
         if font >= 101 and font <= 129:
             font -= 100
@@ -780,9 +1560,9 @@ class Html_output(object):
 
         (ux, uy) = self.WC_to_NDC_rel(self.gkss.chup[0], self.gkss.chup[1], self.gkss.cntnr)
         (ux, uy) = self.seg_xform_rel(ux, uy)
-        self.p.alpha = -atan2(ux, uy)
-        if self.p.alpha < 0:
-            self.p.alpha += 2 * pi
+        alpha = -atan2(ux, uy)
+        if alpha < 0:
+            alpha += 2 * pi
 
         scale = sqrt(self.gkss.chup[0] * self.gkss.chup[0] + self.gkss.chup[1] * self.gkss.chup[1])
         ux = self.gkss.chup[0] / scale * self.gkss.chh
@@ -795,14 +1575,13 @@ class Html_output(object):
 
         height = sqrt(width * width + height * height)
         capheight = round(height * (abs(self.p.c) + 1))
-        self.p.capheight = round(capheight)
 
         fontNum = font - 1
-        size = round(self.p.capheight / capheights[fontNum])
+        size = round(capheight / capheights[fontNum])
 
         if font > 13:
             font += 3
-        self.p.family = (font - 1) / 4
+        family = (font - 1) // 4
         bold = 0 if (font % 4 == 1 or font % 4 == 2) else 1
         italic = (font % 4 == 2 or font % 4 == 0)
 
@@ -814,24 +1593,36 @@ class Html_output(object):
             font_str += 'italic '
 
         font_str += str(size) + 'px '
-        font_str += fonts[self.p.family]
+        font_str += fonts[family]
 
-        if self.p.font != font_str:
-            self.p.font = font_str
-            self.write('c.font = "{0}";\n'.format(font_str))
+        return (alpha, capheight, family, font_str)
 
     def set_color_rep(self, color, red, green, blue):
         if color >= 0 and color < MAX_COLOR:
-            self.p.rgb[color] = [int(255 * red), int(255 * green), int(255 * blue), 255]
+            self.p.rgb[color] = (int(255 * red), int(255 * green), int(255 * blue), 255)
+            self.styles[color] = None
+
+    def style(self, color):
+        ''' return the CSS color string of a color index, built only once '''
+        style = self.styles[color]
+        if style is None:
+            style = 'rgba({0},{1},{2},{3})'.format(*self.p.rgb[color])
+            self.styles[color] = style
+        return style
 
     def set_transparency(self, val):
         self.write('c.globalAlpha = {0};'.format(val))
         self.transparency = val
 
     def init_colors(self):
-        for color in range(MAX_COLOR):
-            (red, green, blue) = gks.inq_rgb(color)
-            self.set_color_rep(color, red, green, blue)
+        global default_rgb, default_styles
+
+        if default_rgb is None:
+            default_rgb = [(int(255 * red), int(255 * green), int(255 * blue), 255)
+                           for (red, green, blue) in gks.inq_color_table()]
+            default_styles = ['rgba({0},{1},{2},{3})'.format(*rgb) for rgb in default_rgb]
+        self.p.rgb = list(default_rgb)
+        self.styles = list(default_styles)
 
     def init_norm_xform(self):
         for tnr in range(MAX_TNR):
@@ -852,6 +1643,26 @@ class Html_output(object):
         yd = self.p.c * yn + self.p.d
         return (xd, yd)
 
+    def xform(self, tnr):
+        ''' return the composed WC to DC matrix of transformation tnr '''
+        if self.xforms[tnr] is None:
+            mat = self.gkss.mat
+            self.xforms[tnr] = mat_mul(
+                ((self.p.a, 0, self.p.b), (0, self.p.c, self.p.d), (0, 0, 1)),
+                mat_mul(((mat[0][0], mat[0][1], mat[2][0]),
+                         (mat[1][0], mat[1][1], mat[2][1]), (0, 0, 1)),
+                        ((a[tnr], 0, b[tnr]), (0, c[tnr], d[tnr]), (0, 0, 1))))
+        return self.xforms[tnr]
+
+    def WC_to_DC(self, n, px, py, tnr):
+        ((m11, m12, m13), (m21, m22, m23), _) = self.xform(tnr)
+        px = px[:n]
+        py = py[:n]
+        if numpy is not None and isinstance(px, numpy.ndarray):
+            return (m11 * px + m12 * py + m13, m21 * px + m22 * py + m23)
+        return ([m11 * x + m12 * y + m13 for (x, y) in zip(px, py)],
+                [m21 * x + m22 * y + m23 for (x, y) in zip(px, py)])
+
     def DC_to_NDC(self, xd, yd):
         xn = (xd - self.p.b) / self.p.a
         yn = (yd - self.p.d) / self.p.c
@@ -862,4 +1673,50 @@ class Html_output(object):
         self.set_clip_rect(tnr)
 
     def write(self, s):
-        self.file.write(self.indentation * '  ' + s)
+        if self.path is not None:
+            self.flush_path()
+        self.out.write(s, self.indentation)
+
+
+class Script_output(Html_output):
+    ''' render a frame into an in-memory script for the live server
+
+    The payload contains only the drawing commands; the page around them
+    is served by the daemon. definitions holds a script that only loads
+    the images, patterns and glyphs introduced by the frame and deletes
+    the images it evicted, for clients which skip it.
+    '''
+
+    def __init__(self, gks_state_list, data, **options):
+        self.filename = 'stream'
+        self.init_output(gks_state_list, Buffered_writer(None, True),
+                         **options)
+        self.footer = ''
+        self.sent_images = self.image_cache.sent
+        try:
+            self.render(data)
+        except Exception:
+            self.forget_frame()
+            raise
+        self.payload = self.out.getvalue()
+        defs = format_defs(self.frame_sources, self.frame_patterns, self.frame_glyphs,
+                           self.frame_deleted)
+        self.definitions = 'load_defs({{{0}}});'.format(defs) if defs else ''
+
+        if self.verbose:
+            self.report()
+
+    def forget_frame(self):
+        ''' undo what rendering recorded as sent, for a frame that is not '''
+        self.sent_images.difference_update(image_id for (image_id, data_uri) in self.frame_sources)
+        # the ids were the newest, so they are handed out again
+        pattern_ids = set(pattern[0] for pattern in self.frame_patterns)
+        for (key, pattern_id) in list(self.patterns.items()):
+            if pattern_id in pattern_ids:
+                del self.patterns[key]
+        glyph_ids = set(glyph[0] for glyph in self.frame_glyphs)
+        for (key, glyph_id) in list(self.glyphs.items()):
+            if glyph_id in glyph_ids:
+                del self.glyphs[key]
+        # the next frame tells the clients about the evicted images
+        self.image_cache.evicted[:0] = self.frame_deleted
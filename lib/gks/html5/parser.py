@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 ''' GKS socket daemon '''
 
-import socket
-from thread import start_new_thread
-from struct import unpack
+from struct import Struct, unpack_from
+from itertools import chain
 import gks
 import html5
 
-HOST = ''
-PORT = 8410
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 page = 0
 fontfile = 0
+image_cache = html5.Image_cache()
+patterns = {}
+glyphs = {}
 
 functionTable = {
     12: ('polyline', 'iDD'),
@@ -27,7 +31,7 @@ functionTable = {
     24: ('set_pmark_size', 'd'),
     25: ('set_pmark_color_index', 'i'),
     27: ('set_text_fontprec', 'ii'),
-    28: ('set_text_expdac', 'd'),
+    28: ('set_text_expfac', 'd'),
     29: ('set_text_spacing', 'd'),
     30: ('set_text_color_index', 'i'),
     31: ('set_text_height', 'd'),
@@ -50,68 +54,177 @@ functionTable = {
     204: ('set_coord_xform', 'dddddd')}
 
 
-def unpackargs(format, data):
-    ''' unpack function arguments and return Python tuple '''
-    args = []
+def compile_format(format):
+    ''' translate an argument format into a list of decoding steps '''
+    steps = []
+    fields = []
+    strings = []
     for fmt in format:
-        if fmt == 'i':
-            args.append(unpack('i', data[:4])[0])
-            data = data[4:]
-            n = args[-1]
-        elif fmt == 'd':
-            args.append(unpack('d', data[:8])[0])
-            data = data[8:]
+        if fmt in 'ids':
+            if fmt == 's':
+                strings.append(len(fields))
+                fields.append('132s')
+            else:
+                fields.append(fmt)
+        else:
+            if fields:
+                steps.append((Struct('=' + ''.join(fields)), tuple(strings)))
+                fields = []
+                strings = []
+            steps.append((fmt, ()))
+    if fields:
+        steps.append((Struct('=' + ''.join(fields)), tuple(strings)))
+    return steps
+
+
+decoders = dict((fctid, (name, compile_format(format)))
+                for (fctid, (name, format)) in functionTable.items())
+formats = {}
+
+item_length = Struct('=i')
+item_header = Struct('=ii')
+array_formats = {'I': ('=%di', 4), 'C': ('=%di', 4), 'D': ('=%dd', 8)}
+if numpy is not None:
+    array_types = {'I': numpy.int32, 'C': numpy.int32, 'D': numpy.float64}
+
+
+def decode_args(steps, data, offset, use_numpy=False):
+    ''' decode function arguments in place, starting at offset
+
+    With use_numpy, coordinate and color arrays are returned as NumPy views
+    into data instead of tuples.
+    '''
+    args = []
+    n = 0
+    for (step, strings) in steps:
+        if step in array_formats:
+            if step == 'I':
+                n = args[-2] * args[-1]
+            (fmt, size) = array_formats[step]
+            if use_numpy:
+                args.append(numpy.frombuffer(data, array_types[step], n,
+                                             offset))
+            else:
+                args.append(unpack_from(fmt % n, data, offset))
+            offset += n * size
+        else:
+            values = step.unpack_from(data, offset)
+            offset += step.size
+            if strings:
+                values = list(values)
+                for i in strings:
+                    values[i] = values[i][:values[i - 1]]
+            args.extend(values)
             n = args[-1]
-        elif fmt == 'I':
-            n = args[-2] * args[-1]
-            args.append(unpack('%di' % n, data[:n * 4]))
-            data = data[n * 4:]
-        elif fmt == 'C':
-            args.append(unpack('%di' % n, data[:n * 4]))
-            data = data[n * 4:]
-        elif fmt == 'D':
-            args.append(unpack('%dd' % n, data[:n * 8]))
-            data = data[n * 8:]
-        elif fmt == 's':
-            args.append(unpack('132s', data[:132])[0][:n])
-            data = data[132:]
     return args
 
 
-def unpack_statelist(data):
-    state_list = gks.state_list()
-    state_list.copy_data(data)
-    return state_list
-
+def unpackargs(format, data, offset=0, use_numpy=False):
+    ''' unpack function arguments and return Python list '''
+    if format not in formats:
+        formats[format] = compile_format(format)
+    return decode_args(formats[format], data, offset,
+                       use_numpy and numpy is not None)
 
-def interp(data):
-    ''' interpret display list '''
-    global page, fontfile
 
-    length = unpack('i', data[:4])[0]
-    state_list = unpack_statelist(data[8:])
-    data = data[length:]
+def decode(data, offset=0, use_numpy=False):
+    ''' iterate over the (name, args) items of a display list '''
+    use_numpy = use_numpy and numpy is not None
+    view = memoryview(data)
+    size = len(view)
+    while size - offset >= 8:
+        (length, fctid) = item_header.unpack_from(view, offset)
+        if length <= 0:
+            break
+        if fctid in decoders:
+            (name, steps) = decoders[fctid]
+            yield (name, decode_args(steps, view, offset + 8, use_numpy))
+        offset += length
 
-    display_list = []
-    length = unpack('i', data[:4])[0]
 
-    offset = 0
-    while length > 0:
-        fctid = unpack('i', data[offset+4:offset+8])[0]
-        if fctid in functionTable.keys():
-            display_list.append((functionTable[fctid][0],
-                                 unpackargs(functionTable[fctid][1],
-                                            data[offset+8:offset+8+length])))
-        offset += length
-        if len(data) - offset < 4:
-            break
-        length = unpack('i', data[offset:offset+4])[0]
+def unpack_statelist(data, offset=0):
+    return gks.state_list.from_buffer_copy(data, offset)
+
+
+class Stream_decoder(object):
+    ''' incremental display list decoder
+
+    Chunks are fed as they arrive; every length-prefixed item is decoded as
+    soon as it is complete, so only the unfinished item is kept in memory.
+    '''
+
+    def __init__(self, use_numpy=False):
+        self.buffer = bytearray()
+        self.state_list = None
+        self.use_numpy = use_numpy and numpy is not None
+        self.done = False
+
+    def feed(self, chunk):
+        ''' append chunk and iterate over the items completed by it '''
+        buf = self.buffer
+        buf += chunk
+        offset = 0
+        size = len(buf)
+        while not self.done and size - offset >= 4:
+            length = item_length.unpack_from(buf, offset)[0]
+            if length <= 0:
+                self.done = True
+            elif size - offset >= length:
+                item = buf[offset:offset + length]
+                offset += length
+                fctid = item_header.unpack_from(item)[1]
+                if self.state_list is None:
+                    self.state_list = unpack_statelist(item, 8)
+                elif fctid in decoders:
+                    (name, steps) = decoders[fctid]
+                    yield (name, decode_args(steps, item, 8, self.use_numpy))
+            else:
+                break
+        del buf[:offset]
+
+    def decode(self, chunks):
+        ''' iterate over the items of a display list arriving in chunks '''
+        for chunk in chunks:
+            if not self.done:
+                for item in self.feed(chunk):
+                    yield item
+
+
+def render(state_list, display_list, live=False, **options):
+    ''' write an HTML page, or return the Script_output if live is set '''
+    global page, fontfile
 
     if not fontfile:
         fontfile = gks.open_font()
 
     state_list.fontfile = fontfile
     gks.init_core(state_list)
+    options.setdefault('image_cache', image_cache)
+
+    if live:
+        options.setdefault('patterns', patterns)
+        options.setdefault('glyphs', glyphs)
+        return html5.Script_output(state_list, display_list, **options)
 
-    html5.Html_output(state_list, display_list, page)
+    html5.Html_output(state_list, display_list, page, **options)
     page += 1
+
+
+def interp(data, use_numpy=numpy is not None, **options):
+    ''' interpret display list '''
+    view = memoryview(data)
+    length = item_length.unpack_from(view)[0]
+    state_list = unpack_statelist(view, 8)
+    return render(state_list, decode(view, length, use_numpy), **options)
+
+
+def interp_stream(chunks, use_numpy=numpy is not None, **options):
+    ''' interpret display list while its chunks arrive '''
+    decoder = Stream_decoder(use_numpy)
+    items = decoder.decode(chunks)
+    first = next(items, None)
+    if decoder.state_list is None:
+        return
+    if first is not None:
+        items = chain((first,), items)
+    return render(decoder.state_list, items, **options)
@@ -1,77 +1,374 @@
-import sys
-import socket
-import bottle
+''' HTML5 GKS daemon
 
-from struct import unpack
-from thread import start_new_thread
-from gevent import monkey
+Display lists arrive from GKS on a TCP socket; the rendered frames are
+pushed to web browsers as server-sent events. Both sides run on one
+asyncio event loop, rendering runs in a worker thread.
+'''
 
-import parser
+import sys
+import os
+import asyncio
+import mimetypes
+import traceback
 
-monkey.patch_all()
+from struct import unpack_from
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
 
-plots = []
-pindex = 0
+import parser
+import html5
 
 HOST = ''
 PORT = 8410
 
-def listen():
-    global plots
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 8080
+ROOT = './'
 
-    sock_stream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        sock_stream.bind((HOST, PORT))
-    except socket.error, msg:
-        print('Bind failed: ' + msg[1])
-        sys.exit()
+# Seconds between comment lines on an idle event stream, which keep
+# proxies from closing the connection.
+KEEPALIVE = 15
 
-    sock_stream.listen(5)
+# Producers which do not name a channel publish here, and /stream shows it.
+DEFAULT_CHANNEL = 'default'
 
-    while True:
-        conn, addr = sock_stream.accept()
-        while True:
-            data = conn.recv(4)
-            if not data:
-                break
-            length = unpack('i', data)[0]
-            data = ''
-            while len(data) < length:
-                chunk = conn.recv(length - len(data))
-                if chunk == '':
-                    break
-                data += chunk
-            if len(data) != length:
-                break
-            plots.append(data.decode('latin-1').encode('utf-8'))
-        conn.close()
-
-@bottle.get('/stream')
-def sendplot():
-    global plots
-    bottle.response.content_type  = 'text/event-stream'
-    bottle.response.cache_control = 'no-cache'
+# The longest channel name a producer may send, in bytes.
+MAX_CHANNEL_NAME = 256
+
+# Renderer options, see Html_output.init_output. Paths are sent as typed
+# arrays, and polylines are reduced to what shows at device resolution.
+RENDER_OPTIONS = {'path_encoding': 'float32', 'decimate': True}
+
+# The renderer keeps module state (the GKS core, the caches), so frames
+# are rendered one at a time, but away from the event loop.
+executor = ThreadPoolExecutor(max_workers=1)
+
+
+class Notifier(object):
+    ''' wake the coroutines waiting for something to happen
+
+    The event is created by the first waiter, so that it belongs to the
+    running loop even if the notifier is created before asyncio.run().
+    '''
+
+    def __init__(self):
+        self.event = None
+
+    def notify(self):
+        if self.event is not None:
+            self.event.set()
+            self.event = None
+
+    async def wait(self, timeout=None):
+        ''' wait for the next notification, return whether there was one '''
+        if self.event is None:
+            self.event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class Frame_hub(object):
+    ''' hand the most recent frames to any number of event stream clients
+
+    Frames are numbered in publishing order and kept in a bounded ring.
+    Each client keeps the number of the last frame it has seen. A client
+    that falls behind gets only the newest frame, preceded by the
+    definitions of the frames it skipped. A client that joins, or that
+    missed definitions which have left the ring, gets all definitions
+    the newest frame may use instead.
+    '''
+
+    def __init__(self, size=16):
+        self.frames = deque()
+        self.size = size
+        self.seq = 0
+        # the newest frame with definitions that has left the ring
+        self.dropped_defs = 0
+        self.published = Notifier()
+        # the definitions published so far, by id; the images evicted by
+        # the newest frame are kept until the next one, as it may draw them
+        self.images = {}
+        self.patterns = {}
+        self.glyphs = {}
+        self.deleted = []
+
+    def publish(self, frame):
+        if len(self.frames) == self.size:
+            (seq, message, definitions) = self.frames.popleft()
+            if definitions:
+                self.dropped_defs = seq
+        self.seq += 1
+        definitions = frame.definitions.replace('\n', '')
+        self.frames.append((self.seq, b'data: ' + frame.payload.replace(b'\n', b'') + b'\n\n',
+                            ('event: defs\ndata: %s\n\n' % definitions).encode() if definitions else b''))
+
+        for image_id in self.deleted:
+            self.images.pop(image_id, None)
+        self.images.update(frame.frame_sources)
+        self.patterns.update((pattern[0], pattern) for pattern in frame.frame_patterns)
+        self.glyphs.update(frame.frame_glyphs)
+        self.deleted = frame.frame_deleted
+
+        self.published.notify()
+
+    def snapshot(self):
+        ''' return the message that replaces the definitions of a client
+            by those the newest frame may use
+        '''
+        definitions = html5.format_defs(list(self.images.items()), list(self.patterns.values()),
+                                        list(self.glyphs.items())).replace('\n', '')
+        return ('event: defs\ndata: reset_defs({%s});\n\n' % definitions).encode()
+
+    def join(self):
+        ''' return the message that brings a new client to the newest
+            frame, and the cursor of that frame
+        '''
+        if not self.frames:
+            return (b'', self.seq)
+        return (self.snapshot() + self.frames[-1][1], self.seq)
+
+    async def wait(self, cursor, timeout=None):
+        ''' wait until a frame newer than cursor is published, return
+            whether there is one
+        '''
+        if cursor == self.seq:
+            await self.published.wait(timeout)
+        return cursor != self.seq
+
+    def since(self, cursor):
+        ''' return the message that brings a client from cursor to the
+            newest frame
+        '''
+        if cursor < self.dropped_defs:
+            return self.join()[0]
+        frames = [frame for frame in self.frames if frame[0] > cursor]
+        return b''.join([definitions for (seq, message, definitions) in frames[:-1]] +
+                        [frames[-1][1]])
+
+
+class Channel(object):
+    ''' the frames of one producer channel and the definitions they use
+
+    The caches belong to the renderer and are only touched by the executor.
+    '''
+
+    def __init__(self):
+        self.hub = Frame_hub()
+        self.image_cache = html5.Image_cache()
+        self.patterns = {}
+        self.glyphs = {}
+
+    def render(self, data):
+        return parser.interp(data, live=True, image_cache=self.image_cache,
+                             patterns=self.patterns, glyphs=self.glyphs,
+                             **RENDER_OPTIONS)
+
+
+# Channels are created by their producers only; the default channel is
+# there from the start. Clients of other channels wait for them.
+channels = {DEFAULT_CHANNEL: Channel()}
+channel_created = Notifier()
+
+
+def channel(name):
+    if name not in channels:
+        channels[name] = Channel()
+        channel_created.notify()
+    return channels[name]
+
+
+class Buffer_pool(object):
+    ''' keep a few frame buffers for reuse, so that large display lists
+        are not allocated anew for every frame
+    '''
+
+    def __init__(self, count=4):
+        self.buffers = []
+        self.count = count
+
+    def get(self, length):
+        ''' return a buffer of at least length bytes '''
+        fitting = [buf for buf in self.buffers if len(buf) >= length]
+        if not fitting:
+            return bytearray(length)
+        buf = min(fitting, key=len)
+        self.buffers.remove(buf)
+        return buf
+
+    def put(self, buf):
+        self.buffers.append(buf)
+        if len(self.buffers) > self.count:
+            self.buffers.remove(min(self.buffers, key=len))
+
+
+pool = Buffer_pool()
+
+
+class Producer(asyncio.BufferedProtocol):
+    ''' publish the frames of a producer connection
+
+    Frames are sent as a 4-byte length followed by the display list. A
+    negative length starts a handshake instead: the channel name follows,
+    -length bytes long, and subsequent frames go to that channel. A
+    producer which sends a longer name than MAX_CHANNEL_NAME, or one that
+    is not UTF-8, is dropped.
+
+    The socket is read straight into the part of the current item that is
+    still missing, display lists into buffers from the pool. Reading
+    pauses while a frame is rendered.
+    '''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.target = channels[DEFAULT_CHANNEL]
+        self.header = bytearray(4)
+        self.expect(self.header, 4, self.header_received)
+
+    def expect(self, buf, length, received):
+        ''' read the next length bytes into buf, then call received '''
+        self.buf = buf
+        self.view = memoryview(buf)[:length]
+        self.filled = 0
+        self.received = received
+        if length == 0:
+            received()
+
+    def get_buffer(self, sizehint):
+        return self.view[self.filled:]
+
+    def buffer_updated(self, nbytes):
+        self.filled += nbytes
+        if self.filled == len(self.view):
+            self.received()
+
+    def header_received(self):
+        length = unpack_from('i', self.header)[0]
+        if length >= 0:
+            self.expect(pool.get(length), length, self.frame_received)
+        elif -length <= MAX_CHANNEL_NAME:
+            self.expect(bytearray(-length), -length, self.name_received)
+        else:
+            self.transport.close()
+
+    def name_received(self):
+        try:
+            self.target = channel(self.buf.decode('utf-8'))
+        except UnicodeDecodeError:
+            self.transport.close()
+            return
+        self.expect(self.header, 4, self.header_received)
+
+    def frame_received(self):
+        self.transport.pause_reading()
+        asyncio.ensure_future(self.publish(self.target, self.buf, self.view))
+        self.expect(self.header, 4, self.header_received)
+
+    async def publish(self, target, buf, data):
+        loop = asyncio.get_running_loop()
+        try:
+            frame = await loop.run_in_executor(executor, target.render, data)
+        except Exception:
+            # drop the frame, but keep the producer connected
+            traceback.print_exc()
+        else:
+            target.hub.publish(frame)
+        pool.put(buf)
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+
+def respond(writer, status, headers=(), body=None):
+    ''' write a response head, and the body if there is one '''
+    head = ['HTTP/1.1 ' + status] + ['%s: %s' % header for header in headers]
+    if body is not None:
+        head += ['Content-Length: %d' % len(body), 'Connection: close']
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+    if body:
+        writer.write(body)
+
+
+async def sendplot(writer, name=DEFAULT_CHANNEL):
+    respond(writer, '200 OK', [('Content-Type', 'text/event-stream'),
+                               ('Cache-Control', 'no-cache')])
 
     # Set client-side auto-reconnect timeout, ms.
-    yield 'retry: 100\n\n'
+    writer.write(b'retry: 100\n\n')
+    await writer.drain()
+
+    # The page may be opened before the producer of its channel connects.
+    while name not in channels:
+        if not await channel_created.wait(KEEPALIVE):
+            writer.write(b': keepalive\n\n')
+            await writer.drain()
+    hub = channels[name].hub
+
+    # A new connection may come from a fresh page without any definitions.
+    (message, cursor) = hub.join()
+    writer.write(message)
+    await writer.drain()
 
     while True:
-        if len(plots) > 0:
-            yield 'data: %s\n\n' % plots.pop().replace('\n','')
+        if not await hub.wait(cursor, KEEPALIVE):
+            writer.write(b': keepalive\n\n')
         else:
-            yield ''
+            writer.write(hub.since(cursor))
+            cursor = hub.seq
+        # a slow client waits here and skips the frames published meanwhile
+        await writer.drain()
 
-@bottle.route('/<filename>')
-def send_static(filename='index.html'):
+
+def send_static(writer, filename='index.html'):
     '''
     return the requested static web page to the web browser
     '''
-    return bottle.static_file(filename, root='./')
+    path = os.path.join(ROOT, filename)
+    if os.path.basename(filename) != filename or not os.path.isfile(path):
+        respond(writer, '404 Not Found', body=b'')
+        return
+    with open(path, 'rb') as f:
+        body = f.read()
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    respond(writer, '200 OK', [('Content-Type', content_type)], body)
+
+
+async def handle_request(reader, writer):
+    ''' answer one HTTP request: /, a static file or an event stream '''
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+        (method, target) = request.split(b'\r\n', 1)[0].decode('latin-1').split()[:2]
+        path = unquote(target.split('?', 1)[0])
+        if method != 'GET':
+            respond(writer, '405 Method Not Allowed', body=b'')
+        elif path == '/stream':
+            await sendplot(writer)
+        elif path.startswith('/stream/'):
+            await sendplot(writer, path[len('/stream/'):])
+        elif path == '/':
+            send_static(writer)
+        else:
+            send_static(writer, path[1:])
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def main():
+    try:
+        await asyncio.get_running_loop().create_server(Producer, HOST or None, PORT)
+    except OSError as e:
+        print('Bind failed: ' + e.strerror)
+        sys.exit()
 
-@bottle.route('/')
-def index():
-    return bottle.static_file('index.html', root='./')
+    server = await asyncio.start_server(handle_request, HTTP_HOST, HTTP_PORT)
+    async with server:
+        await server.serve_forever()
 
-start_new_thread(listen, ())
 
-bottle.run(server=bottle.GeventServer, host='127.0.0.1', port=8080)
+if __name__ == '__main__':
+    asyncio.run(main())
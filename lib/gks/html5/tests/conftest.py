@@ -0,0 +1,40 @@
+''' make the daemon modules importable for the tests
+
+The tests cover the pure Python parts and need no GKS installation. If
+libGKS cannot be loaded, gks is imported against a placeholder library
+whose functions fail when they are called.
+'''
+
+import os
+import sys
+import ctypes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Missing_function(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *args):
+        raise OSError('libGKS is not available, cannot call ' + self.name)
+
+
+class Missing_library(object):
+
+    def __getattr__(self, name):
+        function = Missing_function(name)
+        setattr(self, name, function)
+        return function
+
+
+try:
+    import gks
+except OSError:
+    CDLL = ctypes.CDLL
+    ctypes.CDLL = lambda path: Missing_library()
+    try:
+        import gks
+    finally:
+        ctypes.CDLL = CDLL
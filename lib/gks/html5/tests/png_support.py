@@ -0,0 +1,90 @@
+''' encode cell arrays through both image paths and decode the results '''
+
+import random
+import struct
+import zlib
+from types import SimpleNamespace
+
+import html5
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def output(png_filter='adaptive'):
+    ''' return an Html_output that is just good enough to encode images '''
+    out = html5.Html_output.__new__(html5.Html_output)
+    out.png_level = 6
+    out.png_filter = png_filter
+    out.transparency = 0.5
+    rnd = random.Random(0)
+    out.p = SimpleNamespace(rgb=[(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+                                 for i in range(300)])
+    return out
+
+
+def chunks(png):
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    offset = 8
+    while offset < len(png):
+        (length, tag) = struct.unpack_from('!I4s', png, offset)
+        data = png[offset + 8:offset + 8 + length]
+        assert struct.unpack_from('!I', png, offset + 8 + length)[0] == zlib.crc32(tag + data)
+        yield (tag, data)
+        offset += 12 + length
+
+
+def pixels(png):
+    ''' decode a PNG as written by write_png into RGBA bytes '''
+    data = dict((tag, data) for (tag, data) in chunks(png))
+    (width, height, depth, color_type) = struct.unpack('!2I2B', data[b'IHDR'][:10])
+    bpp = 4 if color_type == 6 else 1
+    raw = zlib.decompress(data[b'IDAT'])
+    stride = width * bpp
+    rows = []
+    previous = bytearray(stride)
+    for j in range(height):
+        kind = raw[j * (stride + 1)]
+        row = bytearray(raw[j * (stride + 1) + 1:(j + 1) * (stride + 1)])
+        for i in range(stride):
+            if kind == 1 and i >= bpp:
+                row[i] = (row[i] + row[i - bpp]) & 0xff
+            elif kind == 2:
+                row[i] = (row[i] + previous[i]) & 0xff
+        assert kind in (0, 1, 2)
+        rows.append(row)
+        previous = row
+    pixels = bytes(b''.join(rows))
+    if color_type == 3:
+        palette = data[b'PLTE']
+        alpha = data.get(b'tRNS', b'')
+        pixels = b''.join(palette[3 * k:3 * k + 3] + (alpha[k:k + 1] or b'\xff') for k in pixels)
+    return pixels
+
+
+def cell_array(rnd, true_color, colors):
+    (dx, dy) = (rnd.randrange(1, 12), rnd.randrange(1, 12))
+    dimx = dx + rnd.randrange(3)
+    if true_color:
+        colia = [rnd.randrange(-2 ** 31, 2 ** 31) for i in range(dimx * dy)]
+    else:
+        colia = [rnd.randrange(colors) for i in range(dimx * dy)]
+    return (dx, dy, dimx, colia, rnd.randrange(1, 40), rnd.randrange(1, 40),
+            rnd.random() < 0.5, rnd.random() < 0.5)
+
+
+def loop_png(out, args, true_color):
+    (dx, dy, dimx, colia, width, height, swapx, swapy) = args
+    pix_buf = out.resample_loop(dx, dy, dimx, colia, width, height, swapx, swapy, true_color)
+    return out.write_png(pix_buf, width, height)
+
+
+def numpy_png(out, args, true_color):
+    (dx, dy, dimx, colia, width, height, swapx, swapy) = args
+    cells = out.resample(dx, dy, dimx, numpy.array(colia, dtype=numpy.int32),
+                         width, height, swapx, swapy)
+    if true_color:
+        return out.write_png(cells.astype('<u4').view(numpy.uint8), width, height)
+    return out.write_indexed_png(cells, width, height)
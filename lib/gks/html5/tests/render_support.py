@@ -0,0 +1,36 @@
+''' render primitives without libGKS '''
+
+import gks
+import html5
+
+# a black default color table with a few distinct colors
+colors = [(0.0, 0.0, 0.0)] * gks.MAX_COLOR
+colors[1:4] = [(1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)]
+
+
+def output(monkeypatch, **options):
+    ''' return an Html_output with the unit square on the whole canvas,
+        which collects its output in memory
+    '''
+    monkeypatch.setattr(gks, 'inq_color_table', lambda: colors)
+    monkeypatch.setattr(gks, 'get_dash_list', lambda ltype, scale: [])
+    monkeypatch.setattr(html5, 'default_rgb', None)
+    state_list = gks.state_list()
+    for tnr in range(gks.MAX_TNR):
+        state_list.window[tnr][:] = [0, 1, 0, 1]
+        state_list.viewport[tnr][:] = [0, 1, 0, 1]
+    state_list.mat[0][0] = state_list.mat[1][1] = 1
+    state_list.asf[:] = [1] * 13
+    state_list.lwidth = 1
+    state_list.ltype = 1
+    state_list.plcoli = state_list.facoli = 1
+    state_list.ints = html5.GKS_K_INTSTYLE_SOLID
+    out = html5.Html_output.__new__(html5.Html_output)
+    out.init_output(state_list, html5.Buffered_writer(), **options)
+    return out
+
+
+def drawn(out):
+    ''' flush pending paths and return the drawing commands '''
+    out.flush_path()
+    return out.out.getvalue().decode()
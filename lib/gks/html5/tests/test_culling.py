@@ -0,0 +1,99 @@
+import pytest
+
+import html5
+from render_support import output, drawn
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+rect = (0, 10, 0, 10)
+arrays = [list] + ([numpy.array] if numpy is not None else [])
+
+
+def test_overlaps():
+    assert html5.overlaps((0, 2, 0, 2), (1, 3, 1, 3))
+    assert html5.overlaps((0, 10, 0, 10), (4, 5, 4, 5))
+    # boxes that only touch do not overlap
+    assert not html5.overlaps((0, 1, 0, 1), (1, 2, 0, 1))
+    assert not html5.overlaps((0, 1, 0, 1), (0, 1, 2, 3))
+
+
+def test_inside():
+    assert html5.inside(rect, 10, 0)
+    assert not html5.inside(rect, 11, 5)
+    assert html5.inside(rect, 11, 5, margin=1)
+    assert not html5.inside(rect, 5, -2, margin=1)
+
+
+@pytest.mark.parametrize('array', arrays)
+def test_bounds(array):
+    assert html5.bounds(array([3, -1, 2]), array([0, 5, -4])) == (-1, 3, -4, 5)
+
+
+@pytest.mark.parametrize('array', arrays)
+def test_points_inside(array):
+    (xd, yd) = html5.points_inside(array([-1, 0, 5, 11, 10]), array([5, 0, 5, 5, 12]), rect)
+    assert (list(xd), list(yd)) == ([0, 5], [0, 5])
+
+
+@pytest.mark.parametrize('array', arrays)
+def test_visible_spans(array):
+    # out to the right, back in diagonally past the corner and out again
+    xd = [5, 20, 30, 20, 5, 15, 25]
+    yd = [5, 5, 5, 20, 5, -5, 20]
+    assert html5.visible_spans(array(xd), array(yd), rect) == [(0, 2), (3, 6)]
+    assert html5.visible_spans(array([20, 30]), array([5, 5]), rect) == []
+    assert html5.visible_spans(array([1, 2, 3]), array([1, 2, 3]), rect) == [(0, 3)]
+
+
+def test_shape_extent():
+    assert html5.shape_extent([], 3) == 3
+    # the corners of a square marker are further away than its radius
+    assert html5.shape_extent([(5, [(-4, -4), (4, -4), (4, 4), (-4, 4)])], 3) == 4
+    assert html5.shape_extent([(1, [(9, 9)])], 3) == 3
+
+
+def test_visible_rect(monkeypatch):
+    out = output(monkeypatch)
+    assert out.visible_rect() == (0, 500, 0, 500)
+    assert out.visible_rect(2) == (-2, 502, -2, 502)
+    out.p.clip_rect = ((400, 300), (100, 200))
+    assert out.visible_rect(1) == (99, 401, 199, 301)
+
+
+def test_hidden_primitives(monkeypatch):
+    out = output(monkeypatch)
+    out.polyline(2, [1.5, 2], [0.5, 0.5])
+    out.fillarea(3, [-1, -0.5, -1], [0, 0, 1])
+    out.gkss.mtype = 2
+    out.polymarker(2, [0.5, 0.5], [1.5, -1])
+    # only the line width of the fill area is set
+    assert drawn(out) == 'c.lineWidth = 1;\n'
+
+
+def test_trimmed_polyline(monkeypatch):
+    out = output(monkeypatch)
+    out.polyline(5, [0.5, 5, 6, 7, 0.5], [0.5, 0.5, 0.5, 0.5, 0.6])
+    commands = drawn(out)
+    # the points far to the right are left out, the line still leaves the canvas
+    assert commands.count('c.moveTo(') == 2
+    assert commands.count('c.lineTo(') == 2
+    assert 'c.moveTo(3493.0' in commands and 'c.lineTo(2994.0' not in commands
+
+
+def test_markers_inside(monkeypatch):
+    out = output(monkeypatch)
+    out.gkss.mtype = 2
+    out.polymarker(3, [0.1, 0.2, 3], [0.1, 0.2, 0.3])
+    assert len(out.path[1][0][0]) == 2
+
+
+def test_no_culling(monkeypatch):
+    out = output(monkeypatch, cull=False)
+    out.polyline(2, [1.5, 2], [0.5, 0.5])
+    out.fillarea(3, [-1, -0.5, -1], [0, 0, 1])
+    commands = drawn(out)
+    assert commands.count('c.stroke();') == 1
+    assert commands.count('c.fill();') == 1
@@ -0,0 +1,41 @@
+import random
+
+import pytest
+
+import html5
+
+numpy = pytest.importorskip('numpy')
+
+
+def test_decimate_columns():
+    xd = [0.1, 0.5, 0.9, 1.2, 1.4, 1.6, 1.8, 2.5]
+    yd = [5.0, 1.0, 3.0, 2.0, 9.0, 0.0, 4.0, 7.0]
+    assert html5.decimate_columns(xd, yd) == (
+        [0.1, 0.5, 0.9, 1.2, 1.4, 1.6, 1.8, 2.5],
+        [5.0, 1.0, 3.0, 2.0, 9.0, 0.0, 4.0, 7.0])
+
+    xd = [0.0, 0.2, 0.4, 0.6, 0.8, 1.0]
+    yd = [2.0, 3.0, 1.0, 3.0, 2.0, 0.0]
+    assert html5.decimate_columns(xd, yd) == (
+        [0.0, 0.2, 0.4, 0.8, 1.0], [2.0, 3.0, 1.0, 2.0, 0.0])
+
+
+def test_decimate_columns_ties():
+    # the lowest and highest values occur twice, the first one is kept
+    xd = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
+    yd = [1.0, 0.0, 4.0, 0.0, 4.0, 2.0, 3.0]
+    expected = ([0.0, 0.1, 0.2, 0.6], [1.0, 0.0, 4.0, 3.0])
+    assert html5.decimate_columns(xd, yd) == expected
+    (x, y) = html5.decimate_columns(numpy.array(xd), numpy.array(yd))
+    assert (x.tolist(), y.tolist()) == expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_decimate_columns_numpy(seed):
+    rnd = random.Random(seed)
+    n = rnd.randrange(1, 400)
+    xd = sorted(rnd.uniform(0, 40) for i in range(n))
+    # few distinct values, so that there are many ties
+    yd = [float(rnd.randrange(5)) for i in range(n)]
+    (x, y) = html5.decimate_columns(numpy.array(xd), numpy.array(yd))
+    assert (x.tolist(), y.tolist()) == html5.decimate_columns(xd, yd)
@@ -0,0 +1,58 @@
+import html5
+
+
+def send(cache, key, data_uri):
+    ''' store an image as image_routine does for a live client '''
+    entry = cache.lookup(key)
+    if entry is None:
+        entry = cache.store(key, data_uri)
+    cache.sent.add(entry[0])
+    return entry[0]
+
+
+def test_lookup():
+    cache = html5.Image_cache()
+    assert cache.lookup(b'a') is None
+    assert cache.store(b'a', 'data:a') == (0, 'data:a')
+    assert cache.store(b'b', 'data:b') == (1, 'data:b')
+    assert cache.lookup(b'a') == (0, 'data:a')
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.size == 12
+
+
+def test_least_recently_used():
+    cache = html5.Image_cache(max_entries=2)
+    assert [send(cache, key, 'data:') for key in (b'a', b'b', b'a', b'c')] == [0, 1, 0, 2]
+    # b was used least recently
+    assert cache.lookup(b'b') is None
+    assert [entry[0] for entry in cache.entries.values()] == [0, 2]
+    assert cache.evicted == [1]
+    assert cache.sent == set([0, 2])
+
+
+def test_evicted_unsent():
+    cache = html5.Image_cache(max_entries=1)
+    cache.store(b'a', 'data:a')
+    cache.store(b'b', 'data:b')
+    # clients never got the image, so they need not delete it
+    assert cache.evicted == []
+
+
+def test_max_bytes():
+    cache = html5.Image_cache(max_bytes=20)
+    send(cache, b'a', 'data:' + 'a' * 5)
+    send(cache, b'b', 'data:' + 'b' * 5)
+    assert cache.evicted == []
+    send(cache, b'c', 'data:' + 'c' * 5)
+    assert cache.evicted == [0]
+    assert cache.size == 20
+
+
+def test_oversized():
+    cache = html5.Image_cache(max_bytes=100)
+    for (i, key) in enumerate((b'a', b'b', b'c')):
+        assert send(cache, key, 'data:' + 'x' * 200) == i
+        # the newest image is kept until the next one replaces it
+        assert list(cache.entries) == [key]
+    assert cache.evicted == [0, 1]
+    assert cache.sent == set([2])
@@ -0,0 +1,157 @@
+import random
+from ctypes import sizeof
+from struct import pack, unpack
+
+import pytest
+
+import gks
+import html5
+import parser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def reference_unpackargs(format, data):
+    ''' the argument decoder the daemon started with '''
+    args = []
+    for fmt in format:
+        if fmt == 'i':
+            args.append(unpack('i', data[:4])[0])
+            data = data[4:]
+            n = args[-1]
+        elif fmt == 'd':
+            args.append(unpack('d', data[:8])[0])
+            data = data[8:]
+            n = args[-1]
+        elif fmt == 'I':
+            n = args[-2] * args[-1]
+            args.append(unpack('%di' % n, data[:n * 4]))
+            data = data[n * 4:]
+        elif fmt == 'C':
+            args.append(unpack('%di' % n, data[:n * 4]))
+            data = data[n * 4:]
+        elif fmt == 'D':
+            args.append(unpack('%dd' % n, data[:n * 8]))
+            data = data[n * 8:]
+        elif fmt == 's':
+            args.append(unpack('132s', data[:132])[0][:n])
+            data = data[132:]
+    return args
+
+
+def reference_decode(data, offset):
+    items = []
+    length = unpack('i', data[offset:offset + 4])[0]
+    while length > 0:
+        fctid = unpack('i', data[offset + 4:offset + 8])[0]
+        if fctid in parser.functionTable:
+            (name, format) = parser.functionTable[fctid]
+            items.append((name, reference_unpackargs(format, data[offset + 8:offset + length])))
+        offset += length
+        if len(data) - offset < 4:
+            break
+        length = unpack('i', data[offset:offset + 4])[0]
+    return items
+
+
+def item(fctid, body):
+    return pack('=ii', 8 + len(body), fctid) + body
+
+
+def display_list(rnd):
+    ''' return a display list with items of every argument format '''
+    state_list = gks.state_list()
+    state_list.lwidth = 1.5
+    items = [item(2, bytes(state_list))]
+    for i in range(40):
+        fctid = rnd.choice(sorted(parser.functionTable) + [99])
+        if fctid in (12, 13, 15):
+            n = rnd.randrange(1, 20)
+            body = pack('=i%dd%dd' % (n, n), n, *[rnd.random() for j in range(2 * n)])
+        elif fctid == 14:
+            text = b'text %d' % i
+            body = pack('=ddi132s', rnd.random(), rnd.random(), len(text), text + b'\xff' * 8)
+        elif fctid in (16, 201):
+            (dx, dy) = (rnd.randrange(1, 6), rnd.randrange(1, 6))
+            colors = [rnd.randrange(-2 ** 31, 2 ** 31) for j in range(dx * dy)]
+            body = pack('=4d3i%di' % len(colors), 0, 1, 0, 1, dx, dy, dx, *colors)
+        elif fctid == 17:
+            n = rnd.randrange(1, 5)
+            body = pack('=i%dd%ddii3i' % (n, n), n, *([0.5] * 2 * n + [-1, 3, 7, 8, 9]))
+        elif fctid == 99:
+            body = b'\x01' * rnd.randrange(0, 16)
+        else:
+            format = parser.functionTable[fctid][1]
+            values = [rnd.randrange(100) if fmt == 'i' else rnd.random() for fmt in format]
+            body = pack('=' + format, *values)
+        items.append(item(fctid, body))
+    return b''.join(items) + pack('=i', 0)
+
+
+def plain(items):
+    ''' turn NumPy arrays into tuples, so that items compare equal '''
+    return [(name, [tuple(arg.tolist()) if numpy is not None and isinstance(arg, numpy.ndarray)
+                    else arg for arg in args])
+            for (name, args) in items]
+
+
+use_numpy = [False] + ([True] if numpy is not None else [])
+
+
+@pytest.mark.parametrize('use_numpy', use_numpy)
+@pytest.mark.parametrize('seed', range(5))
+def test_decode(seed, use_numpy):
+    data = display_list(random.Random(seed))
+    offset = 8 + sizeof(gks.state_list)
+    items = list(parser.decode(data, offset, use_numpy))
+    assert plain(items) == reference_decode(data, offset)
+    assert len(items) > 20
+
+
+def test_decode_numpy_arrays():
+    numpy = pytest.importorskip('numpy')
+    data = item(12, pack('=i2d2d', 2, 0.25, 0.5, 0.75, 1.0)) + pack('=i', 0)
+    [(name, (n, px, py))] = parser.decode(data, 0, use_numpy=True)
+    assert (name, n) == ('polyline', 2)
+    assert isinstance(px, numpy.ndarray) and px.tolist() == [0.25, 0.5]
+    assert py.tolist() == [0.75, 1.0]
+
+
+@pytest.mark.parametrize('use_numpy', use_numpy)
+@pytest.mark.parametrize('seed', range(10))
+def test_stream_decoder(seed, use_numpy):
+    rnd = random.Random(seed)
+    data = display_list(rnd)
+    offset = 8 + sizeof(gks.state_list)
+    chunks = []
+    start = 0
+    while start < len(data):
+        # mostly tiny chunks, which split headers and arrays
+        size = rnd.choice((1, 2, 3, 5, 8, rnd.randrange(1, 600)))
+        chunks.append(data[start:start + size])
+        start += size
+    chunks.append(b'trailing bytes after the end of the list')
+
+    decoder = parser.Stream_decoder(use_numpy)
+    items = list(decoder.decode(chunks))
+    assert plain(items) == reference_decode(data, offset)
+    assert decoder.state_list.lwidth == 1.5
+    assert decoder.done
+
+
+def test_stream_decoder_keeps_partial_item():
+    data = item(19, pack('=i', 3)) + item(20, pack('=d', 2.0))
+    decoder = parser.Stream_decoder()
+    assert list(decoder.feed(item(2, bytes(gks.state_list())) + data[:15])) == [
+        ('set_pline_linetype', [3])]
+    assert len(decoder.buffer) == 3
+    assert list(decoder.feed(data[15:])) == [('set_pline_linewidth', [2.0])]
+    assert not decoder.buffer and not decoder.done
+
+
+def test_handlers():
+    for (name, format) in parser.functionTable.values():
+        assert callable(getattr(html5.Html_output, name, None)), name
@@ -0,0 +1,104 @@
+import base64
+from struct import unpack
+
+import pytest
+
+import html5
+from render_support import output, drawn
+
+# three small triangles, the second one overlaps the first
+triangles = [([0.1, 0.2, 0.1], [0.1, 0.1, 0.2]),
+             ([0.15, 0.25, 0.15], [0.15, 0.15, 0.25]),
+             ([0.5, 0.6, 0.5], [0.5, 0.5, 0.6])]
+
+
+def lines(out, n):
+    for i in range(n):
+        out.polyline(2, [0.1, 0.9], [i / n, i / n])
+
+
+def test_batched_polylines(monkeypatch):
+    out = output(monkeypatch)
+    lines(out, 3)
+    assert out.path is not None
+    commands = drawn(out)
+    assert commands.count('c.beginPath();') == 1
+    assert commands.count('c.moveTo(') == 3
+    assert commands.endswith('c.stroke();\n')
+    assert out.path is None
+
+
+def test_style_change(monkeypatch):
+    out = output(monkeypatch)
+    lines(out, 2)
+    out.gkss.plcoli = 2
+    lines(out, 2)
+    commands = drawn(out)
+    assert commands.count('c.beginPath();') == 2
+    assert commands.count('c.stroke();') == 2
+    # the pending path is stroked before the style changes
+    assert commands.index('c.stroke();') < commands.index('c.strokeStyle="rgba(0,255,0,255)";')
+
+
+def test_max_subpaths(monkeypatch):
+    out = output(monkeypatch)
+    lines(out, html5.MAX_SUBPATHS + 1)
+    commands = drawn(out)
+    assert commands.count('c.beginPath();') == 2
+    assert commands.count('c.moveTo(') == html5.MAX_SUBPATHS + 1
+
+
+@pytest.mark.parametrize('options', [{'batch_paths': False}, {}])
+def test_unbatched_polylines(monkeypatch, options):
+    out = output(monkeypatch, **options)
+    if not options:
+        # with transparency, overlapping lines must be blended one by one
+        out.set_transparency(0.5)
+    lines(out, 3)
+    assert out.path is None
+    commands = drawn(out)
+    assert commands.count('c.beginPath();') == 3
+    assert commands.count('c.stroke();') == 3
+
+
+def test_overlapping_fills(monkeypatch):
+    out = output(monkeypatch)
+    for (px, py) in triangles:
+        out.fillarea(3, px, py)
+    commands = drawn(out)
+    # the overlapping triangle starts a new path, the third one joins it
+    assert commands.count('c.beginPath();') == 2
+    assert commands.count('c.fill();') == 2
+    assert commands.count('c.closePath();') == 3
+    assert commands.count('c.fillStyle=') == 1
+
+
+def test_write_flushes(monkeypatch):
+    out = output(monkeypatch)
+    lines(out, 2)
+    out.set_transparency(0.5)
+    commands = drawn(out)
+    assert commands.index('c.stroke();') < commands.index('c.globalAlpha = 0.5;')
+
+
+def points(commands):
+    [line] = [line for line in commands.splitlines() if line.startswith('draw_sprites(')]
+    (name, array_type, data) = line[len('draw_sprites(c, '):-len('");')].split(', ')
+    assert array_type == 'Int16Array'
+    data = base64.b64decode(data.strip('"'))
+    return unpack('<%dh' % (len(data) // 2), data)
+
+
+def test_sprites(monkeypatch):
+    out = output(monkeypatch)
+    out.gkss.mtype = 2
+    out.gkss.mszsc = 1
+    out.polymarker(2, [0.1, 0.2], [0.1, 0.2])
+    out.polymarker(1, [0.3], [0.3])
+    assert out.path[0][0] == 'sprite'
+    out.polyline(2, [0.1, 0.9], [0.5, 0.5])
+    commands = drawn(out)
+    assert commands.count('make_sprite(') == 1
+    # the markers of both calls are drawn at once, before the line
+    assert points(commands) == (50, 449, 100, 399, 150, 349)
+    assert commands.index('draw_sprites(') < commands.rindex('c.beginPath();')
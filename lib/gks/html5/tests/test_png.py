@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+from png_support import output, chunks, pixels, cell_array, loop_png, numpy_png
+
+numpy = pytest.importorskip('numpy')
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_indexed_pixels(seed):
+    out = output()
+    args = cell_array(random.Random(seed), False, 300)
+    png = numpy_png(out, args, False)
+    assert b'PLTE' in dict(chunks(png))
+    assert pixels(png) == pixels(loop_png(out, args, False))
+
+
+def test_indexed_many_colors_bytes():
+    # more than 256 colors are written as RGBA, like the loop path does
+    out = output(png_filter='none')
+    args = (20, 15, 20, list(range(300)), 40, 30, False, True)
+    png = numpy_png(out, args, False)
+    assert b'PLTE' not in dict(chunks(png))
+    assert png == loop_png(out, args, False)
+
+
+def test_palette():
+    out = output()
+    rgb = out.p.rgb
+    cells = numpy.array([[5, 7, 5], [9, 9, 5]], dtype=numpy.int32)
+    data = dict(chunks(out.write_indexed_png(cells, 3, 2)))
+    assert data[b'IHDR'][9:10] == b'\x03'
+    # only the colors used are in the palette
+    palette = data[b'PLTE']
+    assert len(palette) == 9
+    assert sorted(palette[i:i + 3] for i in range(0, 9, 3)) == sorted(
+        bytes(rgb[ci][:3]) for ci in (5, 7, 9))
+    assert data[b'tRNS'] == b'\x7f' * 3
+
+
+def test_palette_opaque():
+    out = output()
+    out.transparency = 1.0
+    png = out.write_indexed_png(numpy.zeros((4, 4), dtype=numpy.int32), 4, 4)
+    assert len(dict(chunks(png))[b'PLTE']) == 3
+    assert b'tRNS' not in dict(chunks(png))
+    assert pixels(png) == (bytes(out.p.rgb[0][:3]) + b'\xff') * 16
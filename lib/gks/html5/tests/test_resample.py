@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from png_support import output, pixels, cell_array, loop_png, numpy_png
+
+numpy = pytest.importorskip('numpy')
+
+
+def reference(dx, dy, dimx, colia, width, height, swapx, swapy):
+    ''' return the cell shown by each device pixel, row by row '''
+    cells = []
+    for j in range(height):
+        iy = j * dy // height
+        for i in range(width):
+            ix = i * dx // width
+            cells.append(colia[((dy - 1 - iy) if swapy else iy) * dimx +
+                               ((dx - 1 - ix) if swapx else ix)])
+    return cells
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_resample(seed):
+    args = cell_array(random.Random(seed), False, 300)
+    (dx, dy, dimx, colia, width, height, swapx, swapy) = args
+    cells = output().resample(dx, dy, dimx, numpy.array(colia, dtype=numpy.int32),
+                              width, height, swapx, swapy)
+    assert cells.shape == (height, width)
+    assert cells.ravel().tolist() == reference(*args)
+
+
+def test_resample_loop():
+    out = output()
+    # packed colors are stored as 0xAABBGGRR
+    pix_buf = out.resample_loop(2, 1, 3, [0x04030201, -1, 0], 4, 2, True, False, True)
+    assert pix_buf == [255, 255, 255, 255] * 2 + [1, 2, 3, 4] * 2 + \
+        [255, 255, 255, 255] * 2 + [1, 2, 3, 4] * 2
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_true_color_bytes(seed):
+    # without filtering, both paths write the same file
+    out = output(png_filter='none')
+    args = cell_array(random.Random(seed), True, 0)
+    assert numpy_png(out, args, True) == loop_png(out, args, True)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_true_color_pixels(seed):
+    out = output()
+    args = cell_array(random.Random(seed), True, 0)
+    assert pixels(numpy_png(out, args, True)) == pixels(loop_png(out, args, True))
@@ -0,0 +1,240 @@
+import asyncio
+from struct import pack
+from types import SimpleNamespace
+
+import html5
+import server
+
+
+def frame(name, images=(), patterns=(), glyphs=(), deleted=()):
+    ''' return a rendered frame as Script_output leaves it '''
+    defs = html5.format_defs(images, patterns, glyphs, deleted)
+    return SimpleNamespace(payload=('draw_frame(%s);\n' % name).encode(),
+                           definitions='load_defs({%s});' % defs if defs else '',
+                           frame_sources=list(images), frame_patterns=list(patterns),
+                           frame_glyphs=list(glyphs), frame_deleted=list(deleted))
+
+
+def message(name):
+    return ('data: draw_frame(%s);\n\n' % name).encode()
+
+
+def test_since():
+    hub = server.Frame_hub()
+    hub.publish(frame('a', images=[(0, 'data:a')]))
+    hub.publish(frame('b'))
+    hub.publish(frame('c', glyphs=[(0, [[1, 2, 3, 4]])], deleted=[0]))
+    hub.publish(frame('d'))
+    assert hub.seq == 4
+    assert hub.since(3) == message('d')
+    assert hub.since(1) == (b'event: defs\ndata: load_defs({glyphs: {0: [[1, 2, 3, 4]]}, '
+                            b'deleted: [0]});\n\n' + message('d'))
+    assert hub.since(0) == (b'event: defs\ndata: load_defs({images: {0: "data:a"}});\n\n'
+                            b'event: defs\ndata: load_defs({glyphs: {0: [[1, 2, 3, 4]]}, '
+                            b'deleted: [0]});\n\n' + message('d'))
+
+
+def test_join():
+    hub = server.Frame_hub()
+    assert hub.join() == (b'', 0)
+    hub.publish(frame('a', images=[(0, 'data:a'), (1, 'data:b')],
+                      patterns=[(0, [1, 2], '#ff0000')]))
+    hub.publish(frame('b', images=[(2, 'data:c')], deleted=[0]))
+    # the newest frame may still draw the image it evicted
+    assert hub.join() == (b'event: defs\ndata: reset_defs({images: {0: "data:a", '
+                          b'1: "data:b", 2: "data:c"}, patterns: {0: [[1, 2], "#ff0000"]}});\n\n' +
+                          message('b'), 2)
+    hub.publish(frame('c'))
+    assert hub.join() == (b'event: defs\ndata: reset_defs({images: {1: "data:b", '
+                          b'2: "data:c"}, patterns: {0: [[1, 2], "#ff0000"]}});\n\n' +
+                          message('c'), 3)
+
+
+def test_ring_overflow():
+    hub = server.Frame_hub(size=2)
+    hub.publish(frame('a'))
+    hub.publish(frame('b', images=[(0, 'data:a')]))
+    hub.publish(frame('c'))
+    # the frames without definitions that left the ring are not missed
+    assert hub.dropped_defs == 0
+    assert list(hub.frames)[0][0] == 2
+    assert hub.since(0) == (b'event: defs\ndata: load_defs({images: {0: "data:a"}});\n\n' +
+                            message('c'))
+    hub.publish(frame('d'))
+    assert hub.dropped_defs == 2
+    assert hub.since(1) == hub.join()[0]
+    assert hub.since(1).startswith(b'event: defs\ndata: reset_defs({images: {0: "data:a"}});')
+    assert hub.since(2) == message('d')
+
+
+def test_wait():
+    async def run():
+        hub = server.Frame_hub()
+        assert not await hub.wait(0, 0.01)
+        waiting = asyncio.ensure_future(hub.wait(0, 10))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        hub.publish(frame('a'))
+        assert await asyncio.wait_for(waiting, 1)
+        # a client behind the newest frame does not wait
+        assert await asyncio.wait_for(hub.wait(0), 1)
+        assert not await hub.wait(1, 0.01)
+
+    asyncio.run(run())
+
+
+def test_wait_hub_created_before_loop():
+    # like the hub of the default channel, which is created on import
+    hub = server.Frame_hub()
+
+    async def run():
+        waiting = asyncio.ensure_future(hub.wait(0, 10))
+        await asyncio.sleep(0)
+        hub.publish(frame('a'))
+        return await asyncio.wait_for(waiting, 1)
+
+    assert asyncio.run(run())
+
+
+class Writer(object):
+
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_channel_created_later(monkeypatch):
+    monkeypatch.setattr(server, 'KEEPALIVE', 0.01)
+
+    async def run():
+        writer = Writer()
+        client = asyncio.ensure_future(server.sendplot(writer, 'later'))
+        await asyncio.sleep(0.05)
+        # the client waits without creating the channel
+        assert 'later' not in server.channels
+        assert writer.data.startswith(b'HTTP/1.1 200 OK\r\n')
+        assert writer.data.endswith(b': keepalive\n\n')
+        server.channel('later').hub.publish(frame('a'))
+        await asyncio.sleep(0.05)
+        client.cancel()
+        return writer.data
+
+    try:
+        assert message('a') in asyncio.run(run())
+    finally:
+        del server.channels['later']
+
+
+class Transport(object):
+    ''' the socket side of a producer connection '''
+
+    def __init__(self):
+        self.paused = False
+        self.closed = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+
+async def produce(data, chunk_size=3):
+    ''' send data to a Producer in small chunks, as the event loop would,
+        and return the transport and what was not read
+    '''
+    transport = Transport()
+    producer = server.Producer()
+    producer.connection_made(transport)
+    while data and not transport.closed:
+        if transport.paused:
+            await asyncio.sleep(0.001)
+            continue
+        buf = producer.get_buffer(-1)
+        n = min(len(buf), chunk_size, len(data))
+        buf[:n] = data[:n]
+        data = data[n:]
+        producer.buffer_updated(n)
+    while transport.paused and not transport.closed:
+        await asyncio.sleep(0.001)
+    return (transport, data)
+
+
+def test_channel_name_limit():
+    def handshake(name):
+        return asyncio.run(produce(pack('=i', -len(name)) + name))
+
+    name = 'n' * server.MAX_CHANNEL_NAME
+    (transport, rest) = handshake(name.encode())
+    assert not transport.closed
+    assert name in server.channels
+    del server.channels[name]
+    # the producer is dropped before its name is read
+    (transport, rest) = handshake(b'n' * (server.MAX_CHANNEL_NAME + 1))
+    assert transport.closed and len(rest) == server.MAX_CHANNEL_NAME + 1
+    # so is one with a name that is not UTF-8
+    (transport, rest) = handshake(b'\xff\xfe')
+    assert transport.closed and not rest
+    assert list(server.channels) == [server.DEFAULT_CHANNEL]
+
+
+def test_producer(monkeypatch):
+    buffers = []
+
+    def render(self, data):
+        buffers.append(data.obj)
+        if data == b'bad':
+            raise ValueError('bad frame')
+        return frame(bytes(data).decode())
+
+    monkeypatch.setattr(server.Channel, 'render', render)
+    data = b''.join(pack('=i', len(name)) + name for name in (b'one', b'bad', b'two'))
+    data += pack('=i', -3) + b'sim' + pack('=i', 3) + b'six'
+    hub = server.channels[server.DEFAULT_CHANNEL].hub
+    seq = hub.seq
+    try:
+        (transport, rest) = asyncio.run(produce(data))
+        assert not transport.closed and not rest
+        # the frame that failed is left out
+        assert [message for (seq, message, definitions) in hub.frames][-2:] == [
+            message('one'), message('two')]
+        assert hub.seq == seq + 2
+        assert server.channels['sim'].hub.frames[-1][1] == message('six')
+    finally:
+        del server.channels['sim']
+    # the frames are read into the same pooled buffer
+    assert len(set(id(buf) for buf in buffers)) == 1
+
+
+def test_forget_frame():
+    out = html5.Script_output.__new__(html5.Script_output)
+    out.image_cache = html5.Image_cache()
+    out.image_cache.evicted = [7]
+    out.sent_images = out.image_cache.sent
+    out.sent_images.update([1, 2, 3])
+    out.frame_sources = [(3, 'data:c')]
+    out.frame_deleted = [0]
+    out.patterns = {'old': 0, 'new': 1}
+    out.frame_patterns = [(1, [0] * 8, '#000000')]
+    out.glyphs = {'old': 0, 'empty': None, 'new': 2}
+    out.frame_glyphs = [(2, [[0, 0, 1, 1, 2, 2]])]
+    out.forget_frame()
+    assert out.image_cache.sent == set([1, 2])
+    assert out.image_cache.evicted == [0, 7]
+    assert out.patterns == {'old': 0}
+    assert out.glyphs == {'old': 0, 'empty': None}
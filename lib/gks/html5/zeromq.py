@@ -7,15 +7,25 @@ context = zmq.Context()
 socket = context.socket(zmq.PULL)
 socket.connect("tcp://localhost:5556")
 
+
+received = 0
+
+
+def chunks(length):
+    ''' receive the messages of a display list of the given length '''
+    global received
+    received = 0
+    while received < length:
+        chunk = socket.recv()
+        if not chunk:
+            break
+        received += len(chunk)
+        yield chunk
+
+
 while True:
     len_data = socket.recv()
     length = unpack('i', len_data)[0]
-    data = ''
-    while len(data) < length:
-        chunk = socket.recv()
-        if chunk == '':
-            break
-        data += chunk
-    if len(data) != length:
+    parser.interp_stream(chunks(length))
+    if received != length:
         break
-    parser.interp(data)